@@ -0,0 +1,136 @@
+''' Applies an image operation to all images in a directory tree, using all cores.
+
+    python batch.py rotate  <dir> [--degrees -90] [--lossy]
+    python batch.py orient  <dir>       # bake the EXIF orientation into the pixels
+    python batch.py convert <dir>       # write an upright .jpg next to each non-JPEG
+    python batch.py lucky   <dir>       # stretch the contrast, saved upright
+
+Files are streamed from the directory walk into a process pool with a bounded number of
+jobs in flight, so huge archives start processing right away and use little memory.
+'''
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from pathlib import Path
+
+from PIL import Image
+
+import image
+from image import FILETYPES
+
+JPEG_SUFFIXES = ('.jpg', '.jpeg', '.jpe')
+OPERATIONS = ('rotate', 'orient', 'convert', 'lucky')
+
+
+def walk(root):
+    ''' Yields the paths of all images under root, one directory at a time '''
+    try:
+        entries = sorted(os.scandir(root), key=lambda entry: entry.name)
+    except OSError as e:
+        print(f'Cannot read {root}: {e}', file=sys.stderr)
+        return
+    for entry in entries:
+        if entry.name[0] == '.':
+            continue
+        if entry.is_dir(follow_symlinks=False):
+            yield from walk(entry.path)
+        elif os.path.splitext(entry.name)[1].lower() in FILETYPES:
+            yield entry.path
+
+
+def process(operation, path, options):
+    ''' Runs in a worker process. Returns (path, status, seconds, bytes, message) '''
+    start = time.perf_counter()
+    size = 0
+    try:
+        size = os.path.getsize(path)
+        status = run_operation(operation, Path(path), options)
+        message = ''
+    except Exception as e:  # Report and carry on with the other files
+        status, message = 'failed', str(e)
+    return path, status, time.perf_counter() - start, size, message
+
+
+def run_operation(operation, path, options):
+    dry_run = options['dry_run']
+    if operation == 'rotate':
+        if not dry_run:
+            image.rotate(path, options['degrees'], options['lossless'])
+        return 'rotated'
+    if operation == 'orient':
+        if dry_run:
+            with Image.open(path) as im:
+                upright = image.get_orientation(im) not in image.ORIENTATION_TRANSPOSE
+            return 'skipped' if upright else 'oriented'
+        return 'oriented' if image.normalize(path) else 'skipped'
+    if operation == 'convert':
+        target = path.with_suffix('.jpg')
+        if path.suffix.lower() in JPEG_SUFFIXES:
+            return 'skipped'
+        if target.exists() and target.stat().st_mtime >= path.stat().st_mtime:
+            return 'skipped'  # Converted before and the source did not change since
+        if not dry_run:
+            image.convert(path, target)
+        return 'converted'
+    if operation == 'lucky':
+        if not dry_run:
+            image.lucky(path)
+        return 'lucky'
+    raise ValueError(f'Unknown operation {operation}')
+
+
+def run(operation, root, options, workers=None, verbose=True):
+    ''' Processes all images under root and returns a dict with the totals '''
+    workers = workers or os.cpu_count() or 1
+    max_in_flight = workers * 4
+    totals = {'files': 0, 'failed': 0, 'skipped': 0, 'bytes': 0}
+    start = time.perf_counter()
+
+    def report(future):
+        path, status, seconds, size, message = future.result()
+        totals['files'] += 1
+        totals['bytes'] += size
+        if status in ('failed', 'skipped'):
+            totals[status] += 1
+        if verbose:
+            prefix = 'would be ' if options['dry_run'] and status not in ('failed', 'skipped') else ''
+            print(f'{seconds * 1000:8.1f} ms  {prefix}{status:9} {path} {message}'.rstrip())
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        in_flight = set()
+        for path in walk(root):
+            if len(in_flight) >= max_in_flight:
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    report(future)
+            in_flight.add(pool.submit(process, operation, path, options))
+        for future in wait(in_flight).done:
+            report(future)
+
+    totals['seconds'] = time.perf_counter() - start
+    return totals
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Apply an image operation to a directory tree')
+    parser.add_argument('operation', choices=OPERATIONS)
+    parser.add_argument('directory')
+    parser.add_argument('--degrees', type=int, default=-90, help='rotation, counterclockwise')
+    parser.add_argument('--lossy', action='store_true', help='rotate the pixels instead of the EXIF tag')
+    parser.add_argument('--workers', type=int, default=None, help='processes, default is one per core')
+    parser.add_argument('--dry-run', action='store_true', help='only report what would be done')
+    parser.add_argument('--quiet', action='store_true', help='no per-file output')
+    args = parser.parse_args()
+
+    options = {'dry_run': args.dry_run, 'degrees': args.degrees, 'lossless': not args.lossy}
+    totals = run(args.operation, args.directory, options, args.workers, not args.quiet)
+    seconds = totals['seconds']
+    print(f"{totals['files']} files ({totals['skipped']} skipped, {totals['failed']} failed) "
+          f"in {seconds:.1f} s: {totals['files'] / seconds:.1f} files/s, "
+          f"{totals['bytes'] / seconds / 1024 / 1024:.1f} MB/s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,203 @@
+''' Benchmarks the viewer's image path on synthetic fixtures.
+
+    python bench_image.py [--sizes 2,12] [--repeat 5] [--files 20000] [--json out.json]
+    python bench_image.py --baseline out.json [--threshold 0.25]
+
+For JPEG, PNG and TIFF fixtures at each size (in megapixels) and EXIF orientations 1, 3 and 6,
+the stages Image.open + decode, orientate, thumbnail (LANCZOS) and ImageTk.PhotoImage are timed
+separately, as well as the draft decode, image.rotate and reading and writing the description
+with Exif. The metadata cache is cleared before each run, so header reads are timed like on a
+first view. scan_dir and FilePanel.load_dir are timed on a directory with --files entries.
+Stages that need Tk are skipped when no display is available.
+
+Times are the median of --repeat runs in ms. --json writes them with the versions used.
+--baseline compares with an earlier --json file and exits with 1 when a stage got more than
+--threshold slower.
+'''
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import PIL
+from PIL import Image, ImageTk
+
+import image
+import metadata
+from exif import Exif
+from filepanel import scan_dir
+
+FORMATS = {'jpeg': '.jpg', 'png': '.png', 'tiff': '.tif'}
+ORIENTATIONS = (1, 3, 6)
+DISPLAY_BOX = (1200, 800)  # Size the images are fitted in, like a maximized ImagePanel
+NOISE_FLOOR = 1.0  # ms, smaller differences are never reported as regressions
+
+
+def make_fixture(directory, fmt, megapixels, orientation):
+    ''' Gradients with noise, so the files compress like photos and not like flat color '''
+    width = int((megapixels * 1_000_000 * 3 / 2) ** 0.5)
+    size = (width, width * 2 // 3)
+    im = Image.merge('RGB', (Image.linear_gradient('L').resize(size), Image.radial_gradient('L').resize(size),
+                             Image.effect_noise(size, 40)))
+    exif = Image.Exif()
+    exif[image.ORIENTATION_TAG] = orientation
+    path = directory / f'{fmt}-{megapixels}mp-o{orientation}{FORMATS[fmt]}'
+    options = {'quality': 90} if fmt == 'jpeg' else {}
+    im.save(path, exif=exif.tobytes(), **options)
+    return path
+
+
+def median_ms(function, repeat, setup=None):
+    ''' Median time of function(setup()) in ms, setup is not timed '''
+    times = []
+    for _ in range(repeat):
+        argument = setup() if setup else None
+        start = time.perf_counter()
+        function(argument) if setup else function()
+        times.append((time.perf_counter() - start) * 1000)
+    return statistics.median(times)
+
+
+def bench_fixture(path, repeat, root, work):
+    results = {}
+
+    def opened(_=None):
+        im = Image.open(path)
+        im.load()
+        return im
+
+    def uncached(_=None):
+        ''' Forgets the header read of path, so the stages read it like on a first view '''
+        metadata.invalidate(path)
+
+    def opened_uncached():
+        uncached()
+        return opened()
+
+    results['open'] = median_ms(opened, repeat, setup=lambda: None)
+    results['orientate'] = median_ms(image.orientate, repeat, setup=opened_uncached)
+    results['thumbnail'] = median_ms(lambda im: im.thumbnail(DISPLAY_BOX, Image.LANCZOS), repeat,
+                                     setup=lambda: image.orientate(opened()).copy())
+    if root:
+        thumbnail = image.decode_fitted(path, DISPLAY_BOX)
+        results['photoimage'] = median_ms(lambda: ImageTk.PhotoImage(thumbnail), repeat)
+    results['draft'] = median_ms(lambda _: image.decode_draft(path, DISPLAY_BOX), repeat, setup=uncached)
+
+    copy = work / path.name
+    fresh_copy = lambda: shutil.copyfile(path, copy)
+    results['rotate'] = median_ms(lambda _: image.rotate(copy), repeat, setup=fresh_copy)
+    results['exif_read'] = median_ms(lambda _: Exif(str(path)).description, repeat, setup=uncached)
+    counter = iter(range(1_000_000))
+    results['exif_write'] = median_ms(lambda _: setattr(Exif(str(copy)), 'description', f'bench {next(counter)}'),
+                                      repeat, setup=fresh_copy)
+    os.remove(copy)
+    return results
+
+
+def make_directory(directory, files):
+    ''' A large folder of empty image files and some subdirectories, enough for listing '''
+    directory.mkdir()
+    for i in range(files):
+        (directory / f'IMG_{i:06}.jpg').touch()
+    for i in range(files // 100):
+        (directory / f'dir {i}').mkdir()
+        (directory / f'.hidden {i}.txt').touch()
+    return directory
+
+
+def bench_load_dir(root, directory, expected, repeat):
+    ''' Time until all names are in the FilePanel's Listbox '''
+    from filepanel import FilePanel
+    panel = FilePanel(root, select_item_callback=lambda path: None, change_dir_callback=lambda path: None)
+
+    def load(_):
+        panel.load_dir(directory)
+        while panel.filelist.size() < expected + 1:  # + '..'
+            root.update()
+
+    result = median_ms(load, repeat, setup=lambda: None)
+    if panel.watcher:
+        panel.watcher.stop()
+    panel.destroy()
+    return result
+
+
+def compare(results, baseline, threshold):
+    ''' Prints the changes against baseline and returns the names of the stages that regressed '''
+    regressions = []
+    for name, ms in results.items():
+        before = baseline.get(name)
+        if before is None:
+            continue
+        change = (ms - before) / before if before else 0
+        slower = change > threshold and ms - before > NOISE_FLOOR
+        if slower:
+            regressions.append(name)
+        print(f'{name:32} {before:9.2f} -> {ms:9.2f} ms  {change:+7.1%}{"  REGRESSION" if slower else ""}')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark decoding, orienting, resizing and Tk conversion')
+    parser.add_argument('--sizes', default='2,12', help='megapixels, comma separated')
+    parser.add_argument('--formats', default=','.join(FORMATS), help='comma separated')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--files', type=int, default=20000, help='entries in the directory listing benchmark')
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--baseline', help='compare with the results in this file')
+    parser.add_argument('--threshold', type=float, default=0.25, help='fraction slower that is a regression')
+    args = parser.parse_args()
+
+    try:
+        import tkinter
+        root = tkinter.Tk()
+        root.withdraw()
+    except Exception as e:  # No display
+        print(f'Tk not available, skipping photoimage and load_dir: {e}', file=sys.stderr)
+        root = None
+
+    results = {}
+    with tempfile.TemporaryDirectory() as temp:
+        temp = Path(temp)
+        work = temp / 'work'
+        work.mkdir()
+        for fmt in args.formats.split(','):
+            for megapixels in (float(size) if '.' in size else int(size) for size in args.sizes.split(',')):
+                for orientation in ORIENTATIONS:
+                    path = make_fixture(temp, fmt, megapixels, orientation)
+                    for stage, ms in bench_fixture(path, args.repeat, root, work).items():
+                        results[f'{path.stem}/{stage}'] = ms
+                        print(f'{path.stem + "/" + stage:32} {ms:9.2f} ms')
+                    os.remove(path)
+
+        directory = make_directory(temp / 'listing', args.files)
+        results[f'dir-{args.files}/scan_dir'] = median_ms(lambda: scan_dir(directory), args.repeat)
+        if root:
+            results[f'dir-{args.files}/load_dir'] = bench_load_dir(root, directory, args.files + args.files // 100,
+                                                                   args.repeat)
+        for name in results:
+            if name.startswith('dir-'):
+                print(f'{name:32} {results[name]:9.2f} ms')
+
+    if args.json:
+        meta = {'python': platform.python_version(), 'pillow': PIL.__version__, 'platform': platform.platform(),
+                'arguments': vars(args)}
+        with open(args.json, 'w') as f:
+            json.dump({'meta': meta, 'results': results}, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f'{len(regressions)} stages regressed more than {args.threshold:.0%}', file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+''' Benchmarks syncing a synthetic photo tree to a MockImmich server.
+
+    python bench_sync.py [--folders 4] [--files 50] [--kb 200] [--latency 20] [--serial]
+
+The tree is generated from a seed, so runs are comparable. A cold sync starts with an empty
+server and checksum index, a warm sync repeats it with nothing changed. For both the number
+of requests, bytes sent and received, wall time and files/s are reported, so regressions in
+request count or throughput show up. --json writes the results to a file as well.
+'''
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+from PIL import Image
+
+os.environ.setdefault('IMMICH_API_KEY', 'bench')
+
+import checksumindex
+from checksumindex import ChecksumIndex
+from immich import Immich
+from mockimmich import MockImmich
+from sync import sync_folder
+from syncpipeline import sync_folders
+
+
+def make_tree(root, folders, files, kb, seed=0):
+    ''' Writes folders x files JPEGs of about kb KB each. Noise does not compress, so the size
+        follows from the number of pixels. Returns the folder paths. '''
+    rnd = random.Random(seed)
+    side = max(8, int((kb * 1024 / 3) ** 0.5))
+    directories = []
+    for i in range(folders):
+        directory = os.path.join(root, f'{2000 + i} Folder {i}')
+        os.makedirs(directory)
+        for j in range(files):
+            im = Image.frombytes('RGB', (side, side), rnd.randbytes(side * side * 3))
+            im.save(os.path.join(directory, f'IMG_{j:05}.jpg'), quality=95)
+        directories.append(directory)
+    return directories
+
+
+def sync(server, directories, serial, workers):
+    start = time.perf_counter()
+    server.reset_stats()
+    im = Immich(server.url)
+    if serial:
+        for directory in directories:
+            sync_folder(im, directory)
+    else:
+        sync_folders(im, directories, hash_workers=workers, upload_workers=workers, verbose=False)
+    seconds = time.perf_counter() - start
+    files = sum(len(os.listdir(directory)) for directory in directories)
+    return dict(server.stats, seconds=seconds, files=files, files_per_second=files / seconds,
+                endpoints=dict(server.endpoints))
+
+
+def report(name, result):
+    print(f"{name:5} {result['requests']:6} requests ({result['errors']} errors)  "
+          f"{result['bytes_in'] / 1024 / 1024:8.1f} MB up  {result['bytes_out'] / 1024:8.1f} KB down  "
+          f"{result['seconds']:7.2f} s  {result['files_per_second']:8.1f} files/s")
+    for endpoint, count in sorted(result['endpoints'].items()):
+        print(f'        {endpoint:40} {count:6}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark syncing against a mock Immich server')
+    parser.add_argument('--folders', type=int, default=4)
+    parser.add_argument('--files', type=int, default=50, help='per folder')
+    parser.add_argument('--kb', type=int, default=200, help='approximate file size')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--latency', type=float, default=20, help='ms added to every request')
+    parser.add_argument('--error-rate', type=float, default=0, help='fraction of requests that fail with a 503')
+    parser.add_argument('--bandwidth', type=float, default=None, help='MB/s per connection, default unlimited')
+    parser.add_argument('--workers', type=int, default=4, help='hash and upload threads of the pipeline')
+    parser.add_argument('--serial', action='store_true', help='use sync_folder one folder at a time')
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as root:
+        # Private checksum index, so the cold run really hashes everything
+        checksumindex.index = ChecksumIndex(os.path.join(root, 'checksums.sqlite'))
+        directories = make_tree(os.path.join(root, 'photos'), args.folders, args.files, args.kb, args.seed)
+        server = MockImmich(latency=args.latency / 1000, error_rate=args.error_rate, seed=args.seed,
+                            bandwidth=args.bandwidth * 1024 * 1024 if args.bandwidth else None).start()
+        try:
+            results = {'cold': sync(server, directories, args.serial, args.workers),
+                       'warm': sync(server, directories, args.serial, args.workers)}
+        finally:
+            server.stop()
+
+    for name, result in results.items():
+        report(name, result)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'arguments': vars(args), 'results': results}, f, indent=2)
+    if results['warm']['endpoints'].get('POST /api/assets'):
+        print('Warm sync uploaded files again', file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+''' Persistent index of file checksums, so unchanged files don't have to be hashed again.
+Entries are keyed by (device, inode) and only trusted while size and mtime still match.
+'''
+import os
+import sqlite3
+import threading
+from pathlib import Path
+
+INDEX_PATH = Path(os.environ.get('CHECKSUM_INDEX', '~/.cache/imageviewer/checksums.sqlite')).expanduser()
+
+
+class ChecksumIndex:
+    def __init__(self, path=INDEX_PATH):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS checksums (
+                               device INTEGER, inode INTEGER, size INTEGER, mtime INTEGER,
+                               path TEXT, checksum TEXT, PRIMARY KEY (device, inode))''')
+        self.db.commit()
+
+    def lookup(self, st):
+        ''' The checksum stored for the file with stat result st, None if unknown or changed '''
+        with self.lock:
+            row = self.db.execute('SELECT checksum FROM checksums WHERE device=? AND inode=? AND size=? AND mtime=?',
+                                  (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)).fetchone()
+        return row[0] if row else None
+
+    def store(self, path, st, checksum):
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO checksums VALUES (?, ?, ?, ?, ?, ?)',
+                            (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, os.path.abspath(path), checksum))
+            self.db.commit()
+
+    def checksum(self, path, hasher):
+        ''' Returns the checksum of path from the index, or from hasher(path) when the file changed '''
+        st = os.stat(path)
+        checksum = self.lookup(st)
+        if checksum is None:
+            checksum = hasher(path)
+            if os.stat(path).st_mtime_ns == st.st_mtime_ns:  # Don't store a hash of a file being written
+                self.store(path, st, checksum)
+        return checksum
+
+    def entries(self):
+        with self.lock:
+            return self.db.execute('SELECT device, inode, size, mtime, path, checksum FROM checksums').fetchall()
+
+    def prune(self):
+        ''' Removes the entries of files that were deleted or replaced, returns how many '''
+        stale = []
+        for device, inode, size, mtime, path, _ in self.entries():
+            try:
+                st = os.stat(path)
+            except OSError:
+                stale.append((device, inode))
+                continue
+            if (st.st_dev, st.st_ino) != (device, inode):
+                stale.append((device, inode))
+        with self.lock:
+            self.db.executemany('DELETE FROM checksums WHERE device=? AND inode=?', stale)
+            self.db.commit()
+        return len(stale)
+
+    def verify(self, hasher):
+        ''' Rehashes every indexed file that looks unchanged and returns the paths whose content
+            does not match the stored checksum. Those entries are corrected. '''
+        mismatches = []
+        for device, inode, size, mtime, path, checksum in self.entries():
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            if (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns) != (device, inode, size, mtime):
+                continue  # Changed, will be rehashed on next use anyway
+            actual = hasher(path)
+            if actual != checksum:
+                mismatches.append(path)
+                self.store(path, st, actual)
+        return mismatches
+
+
+index = None
+index_lock = threading.Lock()  # Hash workers may ask for the index at the same time
+
+
+def get_index():
+    ''' The index is opened lazily so the database is only created when checksums are used '''
+    global index
+    if index is None:
+        with index_lock:
+            if index is None:
+                index = ChecksumIndex()
+    return index
@@ -1,33 +1,217 @@
+import os
+import shutil
 import struct
+import tempfile
+import threading
+import time
 
 import piexif
 from PIL import Image
 
+import metadata
+from imagecache import cache
+from timing import span
+
+WRITE_DELAY = 0.8  # s without typing before a description edit is written to disk
+
+SOI = b'\xff\xd8'
+SOS = 0xDA
+APP0 = 0xE0
+APP1 = 0xE1
+ORIENTATION_TAG = 0x0112
+SHORT = 3
+
 
 class Exif:
+    ''' Reading goes through the metadata header reader. The file is only opened and its EXIF
+        only parsed with piexif when something is written. '''
+
     def __init__(self, im):
         if isinstance(im, str):
-            self.im = Image.open(im)
+            self._im = None
             self.path = im
         else:
-            self.im = im
+            self._im = im
             self.path = None
-        try:
-            self.data = piexif.load(self.im.info['exif']) if 'exif' in self.im.info else {"0th": {}}
-        except (struct.error, ValueError):
-            self.data = {"0th": {}}
+        self._data = None
+
+    @property
+    def im(self):
+        if self._im is None:
+            self._im = Image.open(self.path)
+        return self._im
+
+    @property
+    def data(self):
+        if self._data is None:
+            try:
+                with span('exif.load'):
+                    self._data = piexif.load(self.im.info['exif']) if 'exif' in self.im.info else {"0th": {}}
+            except (struct.error, ValueError):
+                self._data = {"0th": {}}
+        return self._data
 
     @property
     def description(self):
-        return self.data["0th"].get(piexif.ImageIFD.ImageDescription, b"").decode("utf-8")
+        if self._data is not None:
+            return self._data["0th"].get(piexif.ImageIFD.ImageDescription, b"").decode("utf-8")
+        with span('exif.read'):
+            if self.path:
+                description = metadata.read(self.path).description
+            else:
+                description = metadata.parse_exif(self.im.info.get('exif', b'')).description
+        return (description or b"").decode("utf-8")
 
     @description.setter
     def description(self, value):
         if self.data["0th"].get(piexif.ImageIFD.ImageDescription) != value.encode("utf-8"):
             self.data["0th"][piexif.ImageIFD.ImageDescription] = value.encode("utf-8")
-            exif_bytes = piexif.dump(self.data)
-            if self.path:
-                self.im.save(self.path, exif=exif_bytes)
+            with span('exif.write'):
+                exif_bytes = piexif.dump(self.data)
+                if self.path:
+                    if self.im.format == 'JPEG':
+                        splice_exif(self.path, exif_bytes)  # Lossless, pixel data is copied as is
+                    else:
+                        self.im.save(self.path, exif=exif_bytes)
+                    cache.invalidate(self.path)
+
+
+def splice_exif(path, exif_bytes):
+    ''' Replaces the EXIF (APP1) segment of a JPEG file with exif_bytes as returned by piexif.dump.
+        All other segments and the compressed image data are copied unchanged. The result is
+        written to a temporary file first and renamed over the original. '''
+    path = str(path)
+    if len(exif_bytes) + 2 > 0xFFFF:
+        raise ValueError(f'EXIF data too large for a JPEG segment: {len(exif_bytes)} bytes')
+    segment = bytes([0xFF, APP1]) + struct.pack('>H', len(exif_bytes) + 2) + exif_bytes
+
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', prefix='.', suffix='.tmp')
+    try:
+        with open(path, 'rb') as src, os.fdopen(fd, 'wb') as dst:
+            if src.read(2) != SOI:
+                raise ValueError(f'Not a JPEG file: {path}')
+            dst.write(SOI)
+            written = False
+            while True:
+                marker = src.read(2)
+                if len(marker) < 2 or marker[0] != 0xFF:
+                    raise ValueError(f'Corrupt JPEG file: {path}')
+                if marker[1] == SOS:
+                    break
+                length = src.read(2)
+                body = src.read(struct.unpack('>H', length)[0] - 2)
+                if marker[1] == APP1 and body.startswith(b'Exif\0\0'):
+                    continue  # The old EXIF segment, replaced by ours
+                if not written and marker[1] != APP0:  # JFIF header must stay first
+                    dst.write(segment)
+                    written = True
+                dst.write(marker + length + body)
+            if not written:
+                dst.write(segment)
+            dst.write(marker)
+            shutil.copyfileobj(src, dst, 1024 * 1024)
+        shutil.copymode(path, tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def find_exif_segment(f):
+    ''' Returns the file offset of the TIFF header inside the EXIF segment of the JPEG in f,
+        or None if there is no EXIF segment. Only the segment headers are read. '''
+    f.seek(0)
+    if f.read(2) != SOI:
+        return None
+    while True:
+        marker = f.read(2)
+        if len(marker) < 2 or marker[0] != 0xFF or marker[1] == SOS:
+            return None
+        start = f.tell()
+        length = struct.unpack('>H', f.read(2))[0]
+        if marker[1] == APP1 and f.read(6) == b'Exif\0\0':
+            return f.tell()
+        f.seek(start + length)
+
+
+def set_orientation(path, orientation):
+    ''' Sets the EXIF Orientation tag of a JPEG. When the tag is present its two bytes are
+        overwritten in place, otherwise the EXIF segment is rewritten with splice_exif.
+        The image data is never decoded or re-encoded. '''
+    with open(path, 'r+b') as f:
+        tiff = find_exif_segment(f)
+        if tiff is not None:
+            f.seek(tiff)
+            endian = '<' if f.read(2) == b'II' else '>'
+            f.seek(tiff + 4)
+            ifd = tiff + struct.unpack(endian + 'I', f.read(4))[0]
+            f.seek(ifd)
+            count = struct.unpack(endian + 'H', f.read(2))[0]
+            entries = f.read(12 * count)
+            for i in range(count):
+                tag, typ, n = struct.unpack_from(endian + 'HHI', entries, 12 * i)
+                if tag == ORIENTATION_TAG and typ == SHORT and n == 1:
+                    f.seek(ifd + 2 + 12 * i + 8)
+                    f.write(struct.pack(endian + 'H', orientation))
+                    return
+    exif = Exif(str(path))
+    exif.data['0th'][piexif.ImageIFD.Orientation] = orientation
+    splice_exif(path, piexif.dump(exif.data))
+
+
+class DescriptionWriter:
+    ''' Write-behind for description edits. Edits are collected per file and written in a
+        background thread once the user stopped typing for WRITE_DELAY seconds. '''
+
+    def __init__(self, delay=WRITE_DELAY):
+        self.delay = delay
+        self.pending = {}  # path -> (description, time after which to write it)
+        self.writing = None
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def schedule(self, path, description):
+        with self.condition:
+            self.pending[str(path)] = (description, time.monotonic() + self.delay)
+            self.condition.notify_all()
+
+    def flush(self, path=None):
+        ''' Writes the pending edit for path (or all pending edits) now and waits for it.
+            Call before the file is moved, renamed or deleted and before exiting. '''
+        with self.condition:
+            paths = [str(path)] if path else list(self.pending)
+            for p in paths:
+                if p in self.pending:
+                    self.pending[p] = (self.pending[p][0], 0)
+            self.condition.notify_all()
+            while any(p in self.pending or p == self.writing for p in paths):
+                self.condition.wait()
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while True:
+                    if self.pending:
+                        path, (description, due) = min(self.pending.items(), key=lambda item: item[1][1])
+                        wait = due - time.monotonic()
+                        if wait <= 0:
+                            break
+                        self.condition.wait(wait)
+                    else:
+                        self.condition.wait()
+                del self.pending[path]
+                self.writing = path
+            try:
+                if os.path.isfile(path):
+                    Exif(path).description = description
+            except Exception as e:  # PIL raises KeyError for formats it cannot save, struct.error on bad segments
+                print(f'Cannot write description to {path}: {e}')
+            finally:
+                # Always, or flush() would wait forever
+                with self.condition:
+                    self.writing = None
+                    self.condition.notify_all()
 
 
 if __name__ == "__main__":
@@ -1,3 +1,7 @@
+import bisect
+import os
+import queue
+import threading
 import tkinter
 import tkinter.ttk
 from pathlib import Path
@@ -5,6 +9,40 @@ from pathlib import Path
 import _tkinter
 
 from image import FILETYPES
+from imagecache import cache
+import thumbstore
+from thumbnailgrid import ThumbnailGrid
+import timing
+from timing import span
+from watcher import watch
+
+INSERT_BATCH = 1000  # max names inserted into the Listbox per event loop turn
+SCAN_POLL_INTERVAL = 20  # ms between checks for scan results
+WATCH_POLL_INTERVAL = 250  # ms between checks for changes found by the directory watcher
+
+
+def is_listed(path):
+    ''' True if path should be shown in the file list '''
+    return path.name[0] != '.' and (path.suffix in FILETYPES or path.is_dir())
+
+
+def scan_dir(path, cancelled=lambda: False, inodes=None):
+    ''' Returns the sorted names of the subdirectories and supported images in path, hidden
+        files excluded. Uses the d_type from scandir so no extra stat per entry is needed.
+        Returns None when cancelled() becomes true during the scan. The inodes dict, when
+        given, is filled with name -> inode of the listed names. '''
+    names = []
+    with os.scandir(path) as entries:
+        for i, entry in enumerate(entries):
+            if i % 1000 == 0 and cancelled():
+                return None
+            name = entry.name
+            # Same test as is_listed but with the cached d_type of the entry
+            if name[0] != '.' and (os.path.splitext(name)[1] in FILETYPES or entry.is_dir()):
+                names.append(name)
+                if inodes is not None:
+                    inodes[name] = entry.inode()
+    return sorted(names)
 
 
 class FilePanel(tkinter.ttk.Labelframe):
@@ -14,6 +52,10 @@ class FilePanel(tkinter.ttk.Labelframe):
         tkinter.ttk.Labelframe.__init__(self, parent, text='Files')
 
         self.path = Path()
+        self.scan_generation = 0  # incremented by each load_dir, stale scans stop when it changes
+        self.load_started = None
+        self.scan_results = queue.Queue()
+        self.watcher = None
         self.select_item_callback = select_item_callback
         self.change_dir_callback = change_dir_callback
 
@@ -22,13 +64,19 @@ class FilePanel(tkinter.ttk.Labelframe):
         # there is no ttk.Listbox; however, ttk.Scrollbar
         # works fine with the tkinter Listbox
         self.values = tkinter.Variable(value=[])
-        self.filelist = tkinter.Listbox(self, listvariable=self.values, width=20, height=20)
-        sbar = tkinter.ttk.Scrollbar(self, command=self.filelist.yview, orient=tkinter.VERTICAL)
-        self.filelist.configure(yscrollcommand=sbar.set)
+        self.filelist = tkinter.Listbox(self, listvariable=self.values, width=20, height=20,
+                                        selectmode=tkinter.EXTENDED)
+        self.sbar = tkinter.ttk.Scrollbar(self, command=self.filelist.yview, orient=tkinter.VERTICAL)
+        self.filelist.configure(yscrollcommand=self.sbar.set)
         # self.load_dir()
 
         self.filelist.pack(side=tkinter.LEFT, fill=tkinter.Y, expand=tkinter.Y)
-        sbar.pack(side=tkinter.LEFT, fill=tkinter.Y, expand=tkinter.Y)
+        self.sbar.pack(side=tkinter.LEFT, fill=tkinter.Y, expand=tkinter.Y)
+
+        # Thumbnail view on the same list, swapped in by toggle_view
+        self.grid_view = ThumbnailGrid(self, self.filelist, lambda: self.path, self._change_dir, self._current_index)
+        self.grid_view.configure(yscrollcommand=self.sbar.set)
+        self.grid_mode = False
 
         self.filelist.bind('<<ListboxSelect>>', self._select_item)
         self.filelist.bind('<Double-Button-1>', self._change_dir)
@@ -37,9 +85,43 @@ class FilePanel(tkinter.ttk.Labelframe):
         self.filelist.select_set(0)  # This only sets focus on the first item.
         self.filelist.event_generate("<<ListboxSelect>>")
 
+    def toggle_view(self):
+        ''' Switch between the names-only list and the thumbnail grid '''
+        self.grid_mode = not self.grid_mode
+        if self.grid_mode:
+            self.filelist.pack_forget()
+            self.grid_view.pack(side=tkinter.LEFT, fill=tkinter.BOTH, expand=tkinter.Y, before=self.sbar)
+            self.sbar.configure(command=self.grid_view.yview)
+            self.grid_view.focus_set()
+            index = self._current_index()
+            self.grid_view.see(index if index is not None else 0)
+        else:
+            self.grid_view.pack_forget()
+            self.filelist.pack(side=tkinter.LEFT, fill=tkinter.Y, expand=tkinter.Y, before=self.sbar)
+            self.sbar.configure(command=self.filelist.yview)
+            self.filelist.focus_set()
+
+    def _refresh_grid(self):
+        if self.grid_mode:
+            self.grid_view.redraw()
+
+    def refresh_thumbnail(self, path):
+        ''' The file at path was changed, show its new thumbnail '''
+        self.grid_view.forget(path.name)
+        self._refresh_grid()
+
+    def _current_index(self):
+        ''' Index of the item to show: the active one if it is selected, else the first selected '''
+        selection = self.filelist.curselection()
+        if not selection:
+            return None
+        active = self.filelist.index(tkinter.ACTIVE)
+        return active if active in selection else selection[0]
+
     def _select_item(self, event):
+        self._refresh_grid()
         try:
-            item = self.filelist.get(self.filelist.curselection())
+            item = self.filelist.get(self._current_index())
         except _tkinter.TclError:
             return
         path = self.path / item
@@ -48,15 +130,20 @@ class FilePanel(tkinter.ttk.Labelframe):
             self.select_item_callback(path)
 
     def current_item(self):
-        selection = self.filelist.curselection()
-        if not selection:
+        index = self._current_index()
+        if index is None:
             return Path('')
-        item = self.filelist.get(selection)
+        item = self.filelist.get(index)
         if item == '..':
             return self.path.parent
         else:
             return self.path / item
 
+    def selected_items(self):
+        ''' Paths of all selected files, for actions that work on a batch '''
+        items = [self.filelist.get(index) for index in self.filelist.curselection()]
+        return [self.path / item for item in items if item != '..']
+
     def _change_dir(self, event):
         path = self.current_item()
         if path.is_dir():
@@ -67,28 +154,152 @@ class FilePanel(tkinter.ttk.Labelframe):
         self.path = path
         self.filelist.delete(0, tkinter.END)
         self.filelist.insert(tkinter.END, '..')
-        # populate files list with filenames from
-        # selected directory
-        for f in sorted(path.iterdir()):
-            if (f.is_dir() or f.suffix in FILETYPES) and str(f.name)[0] != '.':
-                self.filelist.insert(tkinter.END, f.name)
+        self.grid_view.reset()
+        if self.watcher:
+            self.watcher.stop()
+            self.watcher = None
+
+        # populate files list with filenames from selected directory,
+        # the directory is read in a thread and the names are inserted in batches
+        self.scan_generation += 1
+        generation = self.scan_generation
+        self.load_started = timing.now()
+        threading.Thread(target=self._scan, args=(path, generation), daemon=True).start()
+        self.after(SCAN_POLL_INTERVAL, self._wait_for_scan, generation)
 
         # prevent <Return> event from propagating to
         # windows higher up in the hierarchy
         return 'break'  # ?? nodig?
 
+    def _scan(self, path, generation):
+        ''' Runs in a worker thread, no Tk calls here '''
+        watcher = None
+        try:
+            # Watch from before the scan so no change can slip in between
+            watcher = watch(path)
+        except OSError as e:
+            print(f'Cannot watch {path}: {e}')
+        inodes = {}
+        try:
+            with span('filepanel.scan_dir'):
+                names = scan_dir(path, lambda: generation != self.scan_generation, inodes)
+        except OSError as e:
+            print(f'Cannot read {path}: {e}')
+            names = []
+        if watcher and names is not None:
+            watcher.start(inodes)  # The scan is the watcher's starting point, no second listing
+        self.scan_results.put((generation, names, watcher))
+
+    def _wait_for_scan(self, generation):
+        if generation != self.scan_generation:
+            return  # A newer load_dir took over
+        try:
+            result_generation, names, watcher = self.scan_results.get_nowait()
+        except queue.Empty:
+            result_generation, names, watcher = None, None, None
+        if result_generation != generation or names is None:  # Not done yet or a stale scan
+            if watcher:
+                watcher.stop()
+            self.after(SCAN_POLL_INTERVAL, self._wait_for_scan, generation)
+        else:
+            self.watcher = watcher
+            self._insert_names(generation, names, 0)
+
+    def _insert_names(self, generation, names, start):
+        if generation != self.scan_generation:
+            return
+        if start >= len(names):
+            timing.record('filepanel.load_dir', self.load_started, timing.now())  # Until all names are listed
+            if self.watcher:
+                self.after(WATCH_POLL_INTERVAL, self._poll_watcher, generation)
+            return
+        self.filelist.insert(tkinter.END, *names[start:start + INSERT_BATCH])
+        self._refresh_grid()
+        self.after(1, self._insert_names, generation, names, start + INSERT_BATCH)
+
+    # -- Applying changes found by the directory watcher --
+
+    def _poll_watcher(self, generation):
+        if generation != self.scan_generation:
+            return
+        while True:
+            try:
+                changes = self.watcher.changes.get_nowait()
+            except queue.Empty:
+                break
+            self.apply_changes(changes)
+        self.after(WATCH_POLL_INTERVAL, self._poll_watcher, generation)
+
+    def apply_changes(self, changes):
+        ''' Update the list in place for files that were added, removed, renamed or modified
+            outside of the viewer. The current selection is kept. '''
+        selection = self.filelist.curselection()
+        current = self._current_index()
+        selected = self.filelist.get(current) if selection else None
+        others = [self.filelist.get(index) for index in selection if index != current]
+
+        # Renamed files may replace a listed one (atomic save), forget what was shown for that name too
+        for name in changes.removed | changes.renamed.keys() | set(changes.renamed.values()) | changes.modified:
+            cache.invalidate(self.path / name)
+            self.grid_view.forget(name)
+            if thumbstore.store:
+                thumbstore.store.invalidate(self.path / name)
+
+        names = list(self.filelist.get(1, tkinter.END))  # Skip '..'
+        gone = changes.removed | changes.renamed.keys()
+        for index in sorted((i for i, name in enumerate(names) if name in gone), reverse=True):
+            self.filelist.delete(index + 1)
+            del names[index]
+        for name in changes.added | set(changes.renamed.values()):
+            if not is_listed(self.path / name):
+                continue
+            index = bisect.bisect_left(names, name)
+            if index < len(names) and names[index] == name:
+                continue  # Already listed by the scan
+            names.insert(index, name)
+            self.filelist.insert(index + 1, name)
+
+        selected = changes.renamed.get(selected, selected)
+        if selection:
+            self.filelist.selection_clear(0, tkinter.END)
+            if '..' in others:
+                self.filelist.select_set(0)
+            for name in (changes.renamed.get(name, name) for name in others):
+                if name in names:
+                    self.filelist.select_set(names.index(name) + 1)
+        if selected == '..':
+            self.filelist.select_set(0)
+        elif selected in names:
+            index = names.index(selected) + 1
+            self.filelist.select_set(index)
+            self.filelist.activate(index)
+        elif selection:
+            # The selected file was removed, continue with the one that took its place
+            index = min(current, self.filelist.size() - 1)
+            self.filelist.select_set(index)
+            self.filelist.activate(index)
+            self.filelist.event_generate('<<ListboxSelect>>')
+        self._refresh_grid()
+
     def delete_current(self):
         # Delete from Listbox
-        selection = self.filelist.curselection()[0]
-        self.filelist.delete(selection)
+        index = self._current_index()
+        if index is None:
+            return
+        self.filelist.delete(index)
         # Set next item active
-        self.filelist.select_set(selection)
+        index = min(index, self.filelist.size() - 1)
+        self.filelist.select_set(index)
+        self.filelist.activate(index)
         self.filelist.event_generate("<<ListboxSelect>>")
 
     def edit_current(self, newname):
-        if not self.filelist.curselection():
+        index = self._current_index()
+        if index is None:
             return
-        selection = self.filelist.curselection()[0]
-        self.filelist.delete(selection)
-        self.filelist.insert(selection, newname)
-        self.filelist.select_set(selection)
+        self.grid_view.forget(self.filelist.get(index))
+        self.filelist.delete(index)
+        self.filelist.insert(index, newname)
+        self.filelist.select_set(index)
+        self.filelist.activate(index)
+        self._refresh_grid()
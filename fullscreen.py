@@ -1,17 +1,23 @@
 from tkinter import Label, TOP, BOTH, YES, CENTER
-from PIL import Image, ImageTk
+from PIL import ImageTk
 from modal import Modal
-from image import orientate, FILETYPES
+from image import load_fitted, load_preview, FILETYPES, REFINE_DELAY
+from prefetch import Prefetcher, PREFETCH_DEPTH, PREFETCH_MEMORY
+from tiles import ZoomWindow
+from timing import span
 
 
 class FullScreen(Modal):
 
-    def __init__(self, root):
+    def __init__(self, root, prefetch_depth=PREFETCH_DEPTH, prefetch_memory=PREFETCH_MEMORY):
         Modal.__init__(self)
         self.width = root.winfo_screenwidth()
         self.height = root.winfo_screenheight()
         self.top.geometry(f"{self.width}x{self.height}+0+0")
         self.imh = None
+        self.refine_job = None
+        self.prefetcher = Prefetcher((self.width, self.height), prefetch_depth, prefetch_memory)
+        self.zoom_window = ZoomWindow(root)
 
         self.labelImage = Label(self.top, image=self.imh, bg="black")
         self.labelImage.pack(side=TOP, fill=BOTH, expand=YES, anchor=CENTER)
@@ -20,6 +26,7 @@ class FullScreen(Modal):
         self.top.bind('<Right>', self.next)
         self.top.bind('<Up>', self.previous)
         self.top.bind('<Left>', self.previous)
+        self.top.bind('z', self.zoom)
 
     def show(self, full_path):
         Modal.show(self)
@@ -32,6 +39,7 @@ class FullScreen(Modal):
         except ValueError:
             self.current = 0
 
+        self.prefetcher.set_list(self.list, self.current)
         self.display_image()
 
     def next(self, event):
@@ -44,12 +52,36 @@ class FullScreen(Modal):
             self.current -= 1
             self.display_image()
 
+    def zoom(self, event):
+        self.zoom_window.show(self.list[self.current], return_to=self)
+
     def display_image(self):
         path = self.list[self.current]
+        self.prefetcher.move_to(self.current)
 
-        im = orientate(Image.open(path))
+        if self.refine_job:
+            self.top.after_cancel(self.refine_job)
+            self.refine_job = None
 
-        im.thumbnail((self.width, self.height), Image.LANCZOS)
+        with span('fullscreen.display_image'):
+            with span('fullscreen.prefetched'):
+                im = self.prefetcher.get(path)
+            if im is None:
+                im, is_final = load_preview(path, (self.width, self.height))
+                if not is_final:
+                    self.refine_job = self.top.after(REFINE_DELAY, self._refine, self.current)
+            self._show_frame(im)
 
-        self.imh = ImageTk.PhotoImage(im)  # ref to image is kept to prevent garbage collection bug
+    def _show_frame(self, im):
+        with span('photoimage'):
+            self.imh = ImageTk.PhotoImage(im)  # ref to image is kept to prevent garbage collection bug
         self.labelImage.configure(image=self.imh)
+
+    def _refine(self, current):
+        self.refine_job = None
+        if current != self.current:
+            return
+        im = self.prefetcher.get(self.list[current])  # the prefetcher may have decoded it meanwhile
+        if im is None:
+            im = load_fitted(self.list[current], (self.width, self.height))
+        self._show_frame(im)
@@ -1,42 +1,188 @@
-from PIL import ExifTags, Image
+import re
+
+from PIL import Image, ImageOps, PngImagePlugin
+
+import metadata
+from exif import set_orientation, ORIENTATION_TAG
+from imagecache import cache
+from timing import span
 # file formats that can be 'read' by PIL
 FILETYPES = ['.bmp', '.dib', '.dcx', '.gif', '.im', '.jpg',
              '.jpe', '.jpeg', '.pcd', '.pcx', '.png', '.pbm',
              '.pgm', '.ppm', '.psd', '.tif', '.tiff', '.xbm', '.xpm']
 
+# 'fast' first shows a reduced (draft) decode and refines it when the user stays on the image,
+# 'quality' always does the full decode with LANCZOS resampling right away.
+PREVIEW_QUALITY = 'fast'
+REFINE_DELAY = 250  # ms to stay on an image before the full quality render replaces the draft
 
-def orientate(im):
+# Transpose that turns the stored pixels into the displayed image, per EXIF orientation
+ORIENTATION_TRANSPOSE = {2: Image.Transpose.FLIP_LEFT_RIGHT, 3: Image.Transpose.ROTATE_180,
+                         4: Image.Transpose.FLIP_TOP_BOTTOM, 5: Image.Transpose.TRANSPOSE,
+                         6: Image.Transpose.ROTATE_270, 7: Image.Transpose.TRANSVERSE,
+                         8: Image.Transpose.ROTATE_90}
+# New orientation after turning the displayed image 90 degrees clockwise
+ORIENTATION_AFTER_CW = {1: 6, 6: 3, 3: 8, 8: 1, 2: 7, 7: 4, 4: 5, 5: 2}
+KEPT_INFO = ('icc_profile', 'dpi', 'comment', 'xmp')  # info written back by normalize, where the format supports it
+XMP_ORIENTATION = re.compile(rb'(tiff:Orientation(?:="|>))[1-8]')
+
+
+def get_orientation(im):
+    ''' EXIF orientation, read from the file header for opened files and from the EXIF bytes
+        of images made in memory '''
     try:
-        exif = dict((ExifTags.TAGS[k], v) for k, v in im._getexif().items() if k in ExifTags.TAGS)
-        orientation = exif.get('Orientation', 1)
-    except (KeyError, AttributeError):
-        orientation = 1
-    if orientation == 3:
-        im = im.rotate(180, expand=True)
-    elif orientation == 6:
-        im = im.rotate(270, expand=True)
-    elif orientation == 8:
-        im = im.rotate(90, expand=True)
+        if getattr(im, 'filename', None):
+            return metadata.read(im.filename).orientation
+        return metadata.parse_exif(im.info['exif']).orientation
+    except (KeyError, OSError):
+        return 1
+
+
+def orientate(im):
+    return apply_orientation(im, get_orientation(im))
+
+
+def apply_orientation(im, orientation):
+    if orientation in ORIENTATION_TRANSPOSE:
+        im = im.transpose(ORIENTATION_TRANSPOSE[orientation])
     elif orientation and orientation != 1:
         print('Unknown orientation:', orientation)
     return im
 
 
-def rotate(path, degrees=-90):
+def decode_fitted(path, size):
+    ''' Opens and orientates the image and shrinks it to fit in size. The image is rotated after
+        shrinking, which gives the same result with fewer pixels to rotate. '''
+    with span('open'):
+        im = Image.open(path)
+    with span('exif'):
+        orientation = get_orientation(im)
+    if orientation in (5, 6, 7, 8):
+        size = (size[1], size[0])  # fit the unrotated image in the rotated box
+    with span('decode'):
+        im.draft(None, (size[0] * 2, size[1] * 2))  # What thumbnail's default reducing_gap does
+        im.load()
+    with span('resize'):
+        im.thumbnail(size, Image.LANCZOS)
+    with span('orientate'):
+        return apply_orientation(im, orientation)
+
+
+def decode_draft(path, size):
+    ''' Fast, lower quality variant of decode_fitted. JPEGs are decoded at 1/2, 1/4 or 1/8
+        scale (the smallest one that still covers size) and rotated after shrinking. '''
+    with span('open'):
+        im = Image.open(path)
+    with span('exif'):
+        orientation = get_orientation(im)
+    if orientation in (5, 6, 7, 8):
+        size = (size[1], size[0])  # fit the unrotated image in the rotated box
+    with span('decode'):
+        im.draft(None, size)
+        im.load()
+    with span('resize'):
+        im.thumbnail(size, Image.BILINEAR, reducing_gap=None)
+    with span('orientate'):
+        return apply_orientation(im, orientation)
+
+
+def load_fitted(path, size):
+    ''' Like decode_fitted but served from the shared image cache when possible.
+        The returned image is shared and should not be modified. '''
+    return cache.get(path, size, decode_fitted)
+
+
+def load_preview(path, size):
+    ''' Returns (image, is_final). With PREVIEW_QUALITY 'fast' this is a draft decode unless the
+        full quality image is already cached; is_final tells whether a refine is still needed. '''
+    if PREVIEW_QUALITY == 'quality':
+        return load_fitted(path, size), True
+    im = cache.lookup(path, size, decode_fitted)
+    if im is not None:
+        return im, True
+    return cache.get(path, size, decode_draft), False
+
+
+def rotate(path, degrees=-90, lossless=True):
     """
     Rotate the given photo the amount of given degreesk, show it and save it
     @param path: The path to the image to edit
-    @param degrees: The number of degrees to rotate the image
+    @param degrees: The number of degrees to rotate the image, a multiple of 90 for lossless
+    @param lossless: For JPEGs only change the EXIF Orientation tag, pixels and metadata are kept
     """
-    im = orientate(Image.open(path))
-    rotated_im = im.rotate(degrees, expand=True)
-    rotated_im.save(path)
+    im = Image.open(path)
+    if lossless and im.format == 'JPEG' and degrees % 90 == 0:
+        orientation = get_orientation(im)
+        if orientation not in ORIENTATION_AFTER_CW:
+            orientation = 1
+        for _ in range((-degrees // 90) % 4):
+            orientation = ORIENTATION_AFTER_CW[orientation]
+        im.close()
+        set_orientation(path, orientation)
+    else:
+        rotated_im = orientate(im).rotate(degrees, expand=True)
+        rotated_im.save(path)
+    cache.invalidate(path)
 
 
-def lucky(path):
-    """
+def rotate_all(paths, degrees=-90, lossless=True):
+    ''' Rotate a batch of photos, files that cannot be rotated are reported and skipped '''
+    for path in paths:
+        try:
+            rotate(path, degrees, lossless)
+        except (OSError, ValueError) as e:
+            print(f'Cannot rotate {path}: {e}')
 
-    """
+
+def normalize(path):
+    ''' Bakes the EXIF orientation into the pixels and resets the tag to 1, keeping the other
+        metadata: the EXIF tags, the ICC profile, dpi, JPEG comment, XMP (with its orientation
+        reset too) and PNG text. Other format specific info is lost, and JPEGs are re-encoded
+        at quality 95. Returns False when the image is already upright. '''
+    im = Image.open(path)
+    orientation = get_orientation(im)
+    if orientation not in ORIENTATION_TRANSPOSE:
+        return False
+    apply_orientation(im, orientation).save(path, **upright_save_options(im, orientation))
+    cache.invalidate(path)
+    return True
+
+
+def upright_save_options(im, orientation):
+    ''' save() arguments that write im's metadata back for a copy with the orientation baked in '''
+    exif = im.getexif()
+    exif[ORIENTATION_TAG] = 1
+    options = {key: im.info[key] for key in KEPT_INFO if im.info.get(key)}
+    if 'dpi' in options and orientation >= 5:  # Turned a quarter, width and height swap
+        options['dpi'] = options['dpi'][::-1]
+    if 'xmp' in options:
+        xmp = options['xmp']
+        options['xmp'] = XMP_ORIENTATION.sub(rb'\g<1>1', xmp.encode() if isinstance(xmp, str) else xmp)
+    if im.format == 'PNG' and getattr(im, 'text', None):
+        options['pnginfo'] = PngImagePlugin.PngInfo()
+        for key, value in im.text.items():
+            options['pnginfo'].add_text(key, value)
+    return dict(options, format=im.format, exif=exif.tobytes(), quality=95)
+
+
+def convert(path, target):
+    ''' Saves an upright copy of the image at target, in the format of target's suffix '''
     im = orientate(Image.open(path))
-    im.im_feeling_lucky()
-    im.save(path)
+    im.convert('RGB').save(target)
+
+
+def lucky(path):
+    ''' One key enhancement: stretches the contrast so the darkest and lightest 1% of the
+        pixels become black and white. The image is saved upright, keeping its metadata like
+        normalize. '''
+    im = Image.open(path)
+    orientation = get_orientation(im)
+    upright = apply_orientation(im, orientation)
+    if upright.mode in ('L', 'RGB'):
+        enhanced = ImageOps.autocontrast(upright, cutoff=1)
+    else:
+        enhanced = ImageOps.autocontrast(upright.convert('RGB'), cutoff=1)
+        if 'A' in upright.getbands():
+            enhanced.putalpha(upright.getchannel('A'))
+    enhanced.save(path, **upright_save_options(im, orientation))
+    cache.invalidate(path)
@@ -0,0 +1,83 @@
+import os
+import threading
+from collections import OrderedDict
+
+import metadata
+
+CACHE_MEMORY = 384 * 1024 * 1024  # max bytes of decoded images kept in the cache
+
+
+class ImageCache:
+    ''' Process wide LRU cache of decoded, oriented and fitted images.
+        Keyed by (path, mtime, size, box, loader) so a changed file is never served from the cache.
+        Cached images are shared: callers must not modify them in place. '''
+
+    def __init__(self, max_bytes=CACHE_MEMORY):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.entries = OrderedDict()  # key -> (image, nbytes)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(path, box, loader):
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        return path, st.st_mtime_ns, st.st_size, tuple(box), loader.__name__
+
+    def lookup(self, path, box, loader):
+        ''' Returns the cached image or None, without loading or counting a miss '''
+        key = self.key(path, box, loader)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+        return None
+
+    def get(self, path, box, loader):
+        ''' Returns the cached image for path and box, calling loader(path, box) on a miss '''
+        key = self.key(path, box, loader)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+
+        im = loader(path, box)
+        nbytes = im.width * im.height * len(im.getbands())
+        with self.lock:
+            if key not in self.entries and nbytes <= self.max_bytes:
+                self.entries[key] = (im, nbytes)
+                self.bytes += nbytes
+                while self.bytes > self.max_bytes:
+                    _, (_, evicted) = self.entries.popitem(last=False)
+                    self.bytes -= evicted
+        return im
+
+    def invalidate(self, path):
+        ''' Drops every cached variant of path, call this whenever the file is changed or moved.
+            The header metadata of path is dropped as well. '''
+        metadata.invalidate(path)
+        path = os.path.abspath(path)
+        with self.lock:
+            for key in [key for key in self.entries if key[0] == path]:
+                _, nbytes = self.entries.pop(key)
+                self.bytes -= nbytes
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'entries': len(self.entries), 'bytes': self.bytes}
+
+
+cache = ImageCache()
@@ -1,9 +1,24 @@
+import os
+from collections import OrderedDict
 from tkinter import Label
-from tkinter import BOTH, YES, CENTER, TOP
+from tkinter import BOTH, YES, CENTER, TOP, NW
 from PIL import Image, ImageTk
 import piexif
 
-from image import orientate
+import timing
+from image import load_fitted, load_preview, REFINE_DELAY
+from timing import span
+
+OVERLAY_INTERVAL = 500  # ms between updates of the timing overlay
+RESIZE_DELAY = 120  # ms without size changes before the image is rendered at the new size
+VARIANTS = 4  # display sizes kept per panel, so toggling the sidebar back and forth is instant
+
+
+def fit(im, box):
+    ''' im shrunk to fit in box, never enlarged '''
+    scale = min(box[0] / im.width, box[1] / im.height, 1)
+    size = (max(1, round(im.width * scale)), max(1, round(im.height * scale)))
+    return im if size == im.size else im.resize(size, Image.LANCZOS, reducing_gap=2.0)
 
 
 class ImagePanel(Label):
@@ -16,17 +31,121 @@ class ImagePanel(Label):
         self.imh = None
         self.labelImage = Label(self, image=self.imh)
         self.labelImage.pack(side=TOP, fill=BOTH, expand=YES, anchor=CENTER)
+        self.current_image_path = None
+        self.current_version = None  # mtime of the file when it was loaded
+        self.box = None  # size the current image was rendered for
+        self.refine_job = None
+        self.resize_job = None
+        # A screen sized rendering of the current image, resizes are rendered from it instead of the file
+        self.source = None
+        self.variants = OrderedDict()  # (path, version, box) -> (image, PhotoImage), latest last
+        self.overlay = None  # Label with the timing report, when shown
+        self.labelImage.bind('<Configure>', self._configure)
 
-    def load_image(self, path):
+    def panel_box(self):
+        return self.labelImage.winfo_width(), self.labelImage.winfo_height()-20
 
-        im = orientate(Image.open(path))
-        im.thumbnail((self.labelImage.winfo_width(), self.labelImage.winfo_height()-20), Image.LANCZOS )
-        self.imh = ImageTk.PhotoImage(im)
-        self.labelImage.configure(image=self.imh, anchor=CENTER)
+    def load_image(self, path):
 
+        box = self.panel_box()
         self.current_image_path = path
+        self.current_version = os.stat(path).st_mtime_ns
+        self.box = box
+        if self.source and self.source[0] != (path, self.current_version):
+            self.source = None
+        if self.refine_job:
+            self.after_cancel(self.refine_job)
+            self.refine_job = None
+
+        variant = self.variants.get((path, self.current_version, box))
+        if variant:
+            self.variants.move_to_end((path, self.current_version, box))
+            self.show_photo(variant[1])
+            return variant[0]
+        with span('panel.load_image'):
+            im, is_final = load_preview(path, box)
+            self.show(im)
+        if not is_final:
+            self.refine_job = self.after(REFINE_DELAY, self._refine, path, box)
         return im
 
+    def show(self, im):
+        with span('photoimage'):
+            self.imh = ImageTk.PhotoImage(im)
+        self.labelImage.configure(image=self.imh, anchor=CENTER)
+
+    def show_photo(self, photo):
+        self.imh = photo
+        self.labelImage.configure(image=self.imh, anchor=CENTER)
+
+    def _refine(self, path, box):
+        ''' Replace the draft preview by the full quality image if the user is still on it '''
+        self.refine_job = None
+        if path != self.current_image_path or box != self.box:
+            return
+        try:
+            with span('panel.refine'):
+                self._render(box)
+        except OSError:
+            pass  # File moved or deleted in the meantime
+
+    def _render(self, box):
+        ''' Shows the current image at box, scaled from the retained source '''
+        key = (self.current_image_path, self.current_version, box)
+        if key not in self.variants:
+            if not self.source or self.source[0] != key[:2]:
+                # Fits any panel size, the decode is shared with FullScreen through the cache
+                screen = (self.winfo_screenwidth(), self.winfo_screenheight())
+                self.source = (key[:2], load_fitted(self.current_image_path, screen))
+            with span('rescale'):
+                im = fit(self.source[1], box)
+            with span('photoimage'):
+                self.variants[key] = (im, ImageTk.PhotoImage(im))
+            while len(self.variants) > VARIANTS:
+                self.variants.popitem(last=False)
+        self.variants.move_to_end(key)
+        self.show_photo(self.variants[key][1])
+
+    def _configure(self, event):
+        # Window resizes and sidebar changes come in bursts, render once they stop
+        if self.current_image_path is None or self.panel_box() == self.box:
+            return
+        if self.resize_job:
+            self.after_cancel(self.resize_job)
+        self.resize_job = self.after(RESIZE_DELAY, self._resized)
+
+    def _resized(self):
+        self.resize_job = None
+        box = self.panel_box()
+        if box == self.box or box[0] <= 1 or box[1] <= 1:
+            return
+        self.box = box
+        if self.refine_job:
+            self.after_cancel(self.refine_job)
+            self.refine_job = None
+        try:
+            with span('panel.resize'):
+                self._render(box)
+        except OSError:
+            pass  # File moved or deleted in the meantime
+
+    def toggle_overlay(self):
+        ''' Shows or hides the timing report on top of the image. Timing is on while it is shown. '''
+        if self.overlay:
+            self.overlay.destroy()
+            self.overlay = None
+            timing.enable(bool(timing.TRACE_PATH))
+            return
+        timing.enable()
+        self.overlay = Label(self, font=('Courier', 11), justify='left', fg='#40ff40', bg='black')
+        self.overlay.place(x=4, y=4, anchor=NW)
+        self._update_overlay()
+
+    def _update_overlay(self):
+        if self.overlay:
+            self.overlay.configure(text=timing.report())
+            self.after(OVERLAY_INTERVAL, self._update_overlay)
+
         # # Haal de Exif-data op
         # exif_data = piexif.load(im.info['exif'])
         #
@@ -5,30 +5,119 @@ import hashlib
 import mimetypes
 import os
 import json
+import random
+import re
 import sys
+import threading
 import time
+import uuid
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
 from functools import wraps
 
 import requests
-from PIL import Image
+from requests.adapters import HTTPAdapter
 from dotenv import load_dotenv
 
+import sniff
+from checksumindex import get_index
 from exif import Exif
 
-def retry_on_connection_error(func):
+HASH_BUFFER = 1024 * 1024  # bytes read per step while hashing, memory use does not depend on file size
+HASH_WORKERS = 4  # files hashed at the same time, hashlib releases the GIL while hashing
+
+POOL_SIZE = 8  # kept-alive connections to the server
+TIMEOUT = (10, 300)  # s to connect, s to wait for data
+MAX_RETRIES = 6  # per request
+RETRY_BUDGET = 200  # retries for the whole session, after that errors are returned right away
+BACKOFF_BASE = 1  # s, doubled for every retry
+BACKOFF_MAX = 120  # s
+RETRY_STATUS = {429, 500, 502, 503, 504}
+BULK_SIZE = 1000  # checksums, album members or deletions per request
+UPLOAD_CHUNK = 256 * 1024  # bytes read from disk per step while uploading
+# Media extensions that older Pythons do not know or map to something else
+MEDIA_TYPES = {'.heic': 'image/heic', '.heif': 'image/heif', '.avif': 'image/avif', '.3gp': 'video/3gpp',
+               '.mts': 'video/mp2t', '.m2ts': 'video/mp2t'}
+for extension, media_type in MEDIA_TYPES.items():
+    mimetypes.add_type(media_type, extension)
+ID_PATTERN = re.compile(r'/[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}')
+
+
+def chunks(items: list, size: int = BULK_SIZE):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+class MultipartUpload:
+    # A multipart/form-data body that reads the file in UPLOAD_CHUNK pieces while it is sent,
+    # so memory use does not depend on the file size. Every iteration starts from the beginning
+    # of the file, which lets a retry send the same body again.
+    def __init__(self, file_path: str, fields: dict, file_field: str = 'assetData', progress=None):
+        self.file_path = file_path
+        self.progress = progress
+        self.boundary = uuid.uuid4().hex
+        content_type = mimetypes.guess_type(file_path)[0] or 'application/octet-stream'
+        parts = [f'--{self.boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'
+                 for name, value in fields.items()]
+        parts.append(f'--{self.boundary}\r\nContent-Disposition: form-data; name="{file_field}"; '
+                     f'filename="{os.path.basename(file_path)}"\r\nContent-Type: {content_type}\r\n\r\n')
+        self.head = ''.join(parts).encode('utf-8')
+        self.tail = f'\r\n--{self.boundary}--\r\n'.encode('utf-8')
+        self.file_size = os.path.getsize(file_path)
+
+    def __len__(self):
+        # Lets requests send a Content-Length instead of a chunked body
+        return len(self.head) + self.file_size + len(self.tail)
+
+    def content_type(self):
+        return f'multipart/form-data; boundary={self.boundary}'
+
+    def __iter__(self):
+        yield self.head
+        sent = 0
+        with open(self.file_path, 'rb') as f:
+            while chunk := f.read(UPLOAD_CHUNK):
+                yield chunk
+                sent += len(chunk)
+                if self.progress:
+                    self.progress(self.file_path, sent, self.file_size)
+        yield self.tail
+
+
+def backoff_delay(attempt: int, response=None):
+    # Honour Retry-After from the server, otherwise exponential backoff with full jitter
+    retry_after = response.headers.get('Retry-After') if response is not None else None
+    if retry_after and retry_after.isdigit():
+        return min(int(retry_after), BACKOFF_MAX)
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+
+def retry_with_backoff(func):
+    # Retries on connection errors, timeouts and 429/5xx responses with jittered exponential
+    # backoff, up to MAX_RETRIES per call and as long as the client's retry budget lasts
     @wraps(func)
-    def wrapper(*args, **kwargs):
+    def wrapper(self, *args, **kwargs):
+        attempt = 0
         while True:
             try:
-                return func(*args, **kwargs)
-            except (requests.exceptions.ReadTimeout, requests.exceptions.ConnectionError):
-                print(".", end='')
-                time.sleep(10)
+                response = func(self, *args, **kwargs)
+                if response.status_code not in RETRY_STATUS:
+                    return response
+                error = None
+            except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as e:
+                response, error = None, e
+            if attempt >= MAX_RETRIES or not self.take_retry():
+                if error:
+                    raise error
+                return response
+            print(".", end='')
+            time.sleep(backoff_delay(attempt, response))
+            attempt += 1
     return wrapper
 
 
 class Immich:
-    def __init__(self, url=''):
+    def __init__(self, url='', pool_size=POOL_SIZE, timeout=TIMEOUT, max_upload_size=None, progress=None):
         if not url:
             url = os.environ['IMMICH_URL']
         self.url = url
@@ -37,123 +126,215 @@ class Immich:
             'Accept': 'application/json',
             'x-api-key': os.environ['IMMICH_API_KEY'],
         }
+        self.timeout = timeout
+        # Files larger than this are reported instead of sent. Lowered when the server answers 413.
+        self.max_upload_size = max_upload_size or int(os.environ.get('IMMICH_MAX_UPLOAD_SIZE', 0)) or None
+        self.progress = progress  # progress(file_path, bytes sent, file size) during uploads
+        # One pooled session so connections are kept alive instead of set up for every request
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.retries_left = RETRY_BUDGET
+        self.latencies = defaultdict(list)  # 'METHOD endpoint' -> list of seconds
+        self.lock = threading.Lock()
+        self.album_index = None  # album name -> id, fetched once and kept up to date locally
+        self.album_lock = threading.Lock()
+
+    def take_retry(self):
+        with self.lock:
+            if self.retries_left <= 0:
+                return False
+            self.retries_left -= 1
+            return True
+
+    @retry_with_backoff
+    def _request(self, method: str, url: str, **kwargs):
+        kwargs.setdefault('headers', self.headers)
+        start = time.perf_counter()
+        try:
+            return self.session.request(method, url, timeout=self.timeout, **kwargs)
+        finally:
+            self._record_latency(method, url, time.perf_counter() - start)
+
+    def _record_latency(self, method: str, url: str, seconds: float):
+        endpoint = ID_PATTERN.sub('/{id}', url[len(self.url):].split('?')[0])
+        with self.lock:
+            self.latencies[f"{method} {endpoint}"].append(seconds)
+
+    def latency_report(self):
+        # One line per endpoint: number of calls, mean, p95 and total time
+        lines = []
+        with self.lock:
+            latencies = {endpoint: sorted(times) for endpoint, times in self.latencies.items()}
+        for endpoint, times in sorted(latencies.items(), key=lambda item: -sum(item[1])):
+            p95 = times[min(len(times) - 1, int(len(times) * 0.95))]
+            lines.append(f"{endpoint:40} {len(times):6}x  mean {sum(times) / len(times) * 1000:7.1f} ms  "
+                         f"p95 {p95 * 1000:7.1f} ms  total {sum(times):7.1f} s")
+        return '\n'.join(lines)
 
-    @retry_on_connection_error
     def get(self, endpoint, payload):
         url = f"{self.url}/api/{endpoint}"
-        response = requests.get(url, headers=self.headers, params=payload)
+        response = self._request('GET', url, params=payload)
         if 200 <= response.status_code < 300:
             return json.loads(response.text)
 
-    @retry_on_connection_error
     def post(self, endpoint, payload, data=None):
         url = f"{self.url}/api/{endpoint}"
         if data:
-            response = requests.post(url, headers=self.headers, data=data)
+            response = self._request('POST', url, data=data)
         else:
-            response = requests.post(url, headers=self.headers, data=json.dumps(payload))
+            response = self._request('POST', url, data=json.dumps(payload))
         return response.status_code, response.json()
 
-    @retry_on_connection_error
     def put(self, endpoint: str, payload: dict):
         url = f"{self.url}/api/{endpoint}"
-        res = requests.put(url, headers=self.headers, data=payload)
+        res = self._request('PUT', url, data=payload)
         if 200 <= res.status_code < 300:
             return res.json()
         panic(f"PUT {url} failed: {res.status_code} {res.text}")
 
     def create_album(self, name: str, description:str = '', assets: list = None):
-        for album in self.albums():
-            if album['albumName'] == name:
-                return album['id']
-        payload = {"albumName": name,  "description": description}
-        if assets:
-            payload['assetIds'] = assets
-        status, data = self.post("albums", payload)
-        if status == 201:
-            return data['id']
+        # Returns the id of the album with this name, creating it if needed
+        with self.album_lock:
+            album_ids = self.album_ids()
+            if name in album_ids:
+                return album_ids[name]
+            payload = {"albumName": name,  "description": description}
+            if assets:
+                payload['assetIds'] = assets
+            status, data = self.post("albums", payload)
+            if status == 201:
+                album_ids[name] = data['id']
+                return data['id']
 
-    @retry_on_connection_error
     def delete(self, endpoint: str, payload: dict):
         url = f"{self.url}/api/{endpoint}"
-        return requests.delete(url, headers=self.headers, data=payload)
+        return self._request('DELETE', url, data=payload)
 
     ##### Assets #####
 
-    def upload_asset(self, file_path: str):
+    def upload_asset(self, file_path: str, checked: bool = False, progress=None):
         # Returns: {'id': '948070b4-150d-49d3-89fd-db47095ffaa9', 'status': 'created'}
+        # Pass checked=True when existing_assets was already asked about this file
+        st = os.stat(file_path)
+        file_size = st.st_size
+        if self.max_upload_size and file_size > self.max_upload_size:
+            print(f"File too large ({file_size}): {file_path}")
+            return None
         local_checksum = calulate_checksum(file_path)
-        search_results = self.find_assets({'checksum': local_checksum})
-        if search_results:
-            return search_results[0]['id']
-        headers = {
-            'Accept': 'application/json',
-            'x-api-key': os.environ['IMMICH_API_KEY'],
-            'x-immich-checksum': local_checksum
-        }
+        if not checked:
+            existing = self.existing_assets([local_checksum])
+            if local_checksum in existing:
+                return existing[local_checksum]
         folder = file_path.split('/')[-2]
         payload = {
             'deviceAssetId': file_path,
             'deviceId': 'Macbook',
-            'fileCreatedAt': folder[:4]+datetime.datetime.fromtimestamp(os.stat(file_path).st_birthtime).isoformat()[4:],
-            'fileModifiedAt': datetime.datetime.fromtimestamp(os.path.getmtime(file_path)).isoformat()
+            'fileCreatedAt': folder[:4]+datetime.datetime.fromtimestamp(getattr(st, 'st_birthtime', st.st_mtime)).isoformat()[4:],
+            'fileModifiedAt': datetime.datetime.fromtimestamp(st.st_mtime).isoformat()
         }
-        if is_image(file_path):
-            payload['description'] = Exif(file_path).description
+        if sniff.category(file_path) == 'image':
+            try:
+                payload['description'] = Exif(file_path).description
+            except (OSError, SyntaxError, UnicodeDecodeError):
+                pass  # Not a readable image, upload it without description
 
-        with open(file_path, 'rb') as f:
-            files = {'assetData': (os.path.basename(file_path), f, 'image/jpeg')}
-            response = self._post_asset(f"{self.url}/api/assets", headers=headers, files=files, payload=payload)
+        # The body is built once and streamed from disk, a retry restarts it without re-reading metadata
+        body = MultipartUpload(file_path, payload, progress=progress or self.progress)
+        headers = {
+            'Accept': 'application/json',
+            'Content-Type': body.content_type(),
+            'x-api-key': os.environ['IMMICH_API_KEY'],
+            'x-immich-checksum': local_checksum
+        }
+        response = self._post_asset(f"{self.url}/api/assets", headers=headers, body=body)
         if 200 <= response.status_code < 300:
             data = response.json()
             return data['id']
         elif response.status_code == 413:
-            print(f"File too large ({os.path.getsize(file_path)}): {file_path}")
+            print(f"File too large ({file_size}): {file_path}")
             # 123_234_464
+            with self.lock:
+                if not self.max_upload_size or file_size <= self.max_upload_size:
+                    self.max_upload_size = file_size - 1  # Don't send anything this large again
         else:
             panic(f"Upload failed: {response.status_code} {response.text}")
 
-    @retry_on_connection_error
-    def _post_asset(self, url, headers, files, payload):
-        return requests.post(url, headers=headers, files=files, data=payload)
+    def _post_asset(self, url, headers, body):
+        return self._request('POST', url, headers=headers, data=body)
+
+    def existing_assets(self, checksums: list):
+        # Returns {checksum: asset id} for the checksums that are already on the server,
+        # asking for BULK_SIZE checksums per request
+        existing = {}
+        for chunk in chunks(list(checksums)):
+            payload = {'assets': [{'id': checksum, 'checksum': checksum} for checksum in chunk]}
+            status, data = self.post("assets/bulk-upload-check", payload)
+            if status != 200:
+                panic(f"Upload check failed: {status} {data}")
+            for result in data['results']:
+                if result['action'] == 'reject' and result.get('assetId'):
+                    existing[result['id']] = result['assetId']
+        return existing
 
     def asset_info(self, asset_id: str):
         return self.get(f"assets/{asset_id}", {})
 
     def find_assets(self, searchparams: dict):
-        result = []
+        # Yields the matching assets, fetching the next page only when the caller gets there
+        searchparams = dict(searchparams)
         while True:
             status, data = self.post("search/metadata", searchparams)
-            if status == 200:
-                result += data['assets']['items'] # Voor nu alleen de eerste pagina
-                if True or not data['assets']['nextPage']:
-                    return result
-                searchparams['page'] = data['assets']['nextPage']
-            else:
+            if status != 200:
                 panic(f"Search failed: {status} {data}")
+            yield from data['assets']['items']
+            if not data['assets']['nextPage']:
+                return
+            searchparams['page'] = int(data['assets']['nextPage'])
 
     def delete_assets(self, asset_ids: list):
-        payload = json.dumps({
-            "force": True,
-            "ids":asset_ids
-        })
-        return self.delete("assets", payload=payload)
+        responses = []
+        for chunk in chunks(asset_ids):
+            payload = json.dumps({
+                "force": True,
+                "ids": chunk
+            })
+            responses.append(self.delete("assets", payload=payload))
+        return responses
 
     ##### Albums ####
 
     def albums(self):
         return self.get("albums", {})
 
+    def album_ids(self):
+        # Album name -> id, fetched from the server on first use only
+        if self.album_index is None:
+            self.album_index = {album['albumName']: album['id'] for album in self.albums()}
+        return self.album_index
+
     def album_info(self, album_id: str):
         return self.get(f"albums/{album_id}", {})
 
     def delete_album(self, album_id: str):
-        return self.delete(f"albums/{album_id}", {})
+        response = self.delete(f"albums/{album_id}", {})
+        with self.album_lock:
+            if self.album_index is not None and 200 <= response.status_code < 300:
+                self.album_index = {name: id for name, id in self.album_index.items() if id != album_id}
+        return response
 
     def add_asset_to_album(self, album_id: str, asset_id: str):
         payload = json.dumps({"ids": [asset_id]})
         return self.put(f"albums/{album_id}/assets", payload)
 
+    def add_assets_to_album(self, album_id: str, asset_ids: list):
+        # Same result format as add_asset_to_album: one {'id', 'success', 'error'} per asset
+        results = []
+        for chunk in chunks(asset_ids):
+            results += self.put(f"albums/{album_id}/assets", json.dumps({"ids": chunk}))
+        return results
+
     def remove_asset_from_album(self, asset_id: str, album_id: str):
         payload = {"ids": [album_id]}
         return self.delete("assets/{asset_id}/albums", payload)
@@ -169,40 +350,78 @@ class Immich:
     def upload_folder(self, path: str):
         album_name = path.rsplit('/', 1)[1]
         album_id = self.create_album(album_name)
-        for file in sorted(os.listdir(path)):
-            full_path = f"{path}/{file}"
-            if is_image(full_path):
+        files = {calulate_checksum(full_path): full_path
+                 for full_path in (f"{path}/{file}" for file in sorted(os.listdir(path))) if is_image(full_path)}
+        existing = self.existing_assets(files)
+        asset_ids = list(existing.values())
+        for checksum, full_path in files.items():
+            if checksum not in existing:
                 print(full_path)
-                asset_id = self.upload_asset(full_path)
+                asset_id = self.upload_asset(full_path, checked=True)
                 if asset_id:
-                    self.add_asset_to_album(album_id, asset_id)
+                    asset_ids.append(asset_id)
+        self.add_assets_to_album(album_id, asset_ids)
 
 
-def is_image(file_path):
-    try:
-        with Image.open(file_path) as img:
-            img.verify()
-        return True
-    except (IOError, SyntaxError):
+def media_kind(file_path):
+    # 'image' or 'video' by the extension, the cheap first filter before the file is read
+    mime_type, _ = mimetypes.guess_type(file_path)
+    kind = mime_type.split('/')[0] if mime_type else None
+    return kind if kind in ('image', 'video') else None
+
+
+def is_image(file_path, deep=False):
+    # Decided on the extension and the first bytes of the file. deep=True also parses the whole image, for audits.
+    if media_kind(file_path) != 'image' or sniff.category(file_path) != 'image':
         return False
+    return not deep or sniff.verify(file_path)
 
 
-def is_image_or_video(file_path):
-    mime_type, _ = mimetypes.guess_type(file_path)
-    if mime_type and mime_type.startswith("video"):
+def is_image_or_video(file_path, deep=False):
+    kind = media_kind(file_path)
+    if not kind:
+        return False
+    category = sniff.category(file_path)
+    if category == 'image':
+        return not deep or sniff.verify(file_path)
+    if category == 'video':
         return True
-    if mime_type and mime_type.startswith("image"):
-        return is_image(file_path)
-    return False
+    return kind == 'video'  # A container the sniffer does not know
+
 
+def calulate_checksum(file_path: str, use_index: bool = True):
+    # Files whose (device, inode, size, mtime) did not change are not hashed again
+    if use_index:
+        return get_index().checksum(file_path, hash_file)
+    return hash_file(file_path)
 
-def calulate_checksum(file_path: str):
-    with open(file_path, "rb") as f:
-        file_hash = hashlib.sha1(f.read()).digest()
-    checksum = base64.b64encode(file_hash).decode("utf-8")
+
+def hash_file(file_path: str):
+    file_hash = hashlib.sha1()
+    buffer = bytearray(HASH_BUFFER)
+    view = memoryview(buffer)
+    with open(file_path, "rb", buffering=0) as f:
+        while size := f.readinto(buffer):
+            file_hash.update(view[:size])
+    checksum = base64.b64encode(file_hash.digest()).decode("utf-8")
     return checksum
 
 
+def calculate_checksums(file_paths, workers: int = HASH_WORKERS):
+    # Yields (file_path, checksum) in the order of file_paths, hashing up to `workers` files at
+    # once. At most 2 * workers files are in flight, so memory stays bounded for long lists.
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        in_flight = deque()
+        for file_path in file_paths:
+            if len(in_flight) >= 2 * workers:
+                path, future = in_flight.popleft()
+                yield path, future.result()
+            in_flight.append((file_path, pool.submit(calulate_checksum, file_path)))
+        while in_flight:
+            path, future = in_flight.popleft()
+            yield path, future.result()
+
+
 def panic(message:str):
     print(message)
     sys.exit()
\ No newline at end of file
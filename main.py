@@ -7,12 +7,14 @@ from pathlib import Path
 import piexif
 
 import image
+from imagecache import cache
 from dirpanel import DirPanel
-from exif import Exif
+from exif import Exif, DescriptionWriter
 from filepanel import FilePanel
 from imagepanel import ImagePanel
 from filenamepopup import FilenamePopup
 from fullscreen import FullScreen
+from tiles import ZoomWindow
 import subprocess
 import collections
 
@@ -33,6 +35,8 @@ SpecialAction = collections.namedtuple('SpecialAction', 'action path')
 class ImageViewer(ttk.Frame):
     def __init__(self):
         self.special_actions = []
+        self.description_writer = DescriptionWriter()
+        self.loaded_description = None  # (path, description) as put in the text entry by load_image
 
         ttk.Frame.__init__(self, name='imageviewer')
         self.master.title('Image Viewer')
@@ -44,6 +48,9 @@ class ImageViewer(ttk.Frame):
         self.master.bind('<Control-m>', self.move_image)
         self.master.bind('<Control-r>', self.rotate_image)
         self.master.bind('<Control-l>', self.lucky)
+        self.master.bind('<Control-g>', self.toggle_grid)
+        self.master.bind('<Control-z>', self.zoom)
+        self.master.bind('<Control-t>', self.toggle_timing)
         self.master.bind('<Return>', self.switch_to_fullscreen)
         self.master.bind('<Key>', self.keypress)
 
@@ -95,27 +102,30 @@ class ImageViewer(ttk.Frame):
         self.after(1, self._on_text_change)  # Delay om geplakte tekst te detecteren
 
     def load_image(self, path):
-        im = self.imagePanel.load_image(path)
+        # An edit of this image may still be waiting to be written, read it back from the file
+        self.description_writer.flush(path)
+        self.imagePanel.load_image(path)
         # Haal Exif-data op en laad beschrijving in text_entry
         try:
-            self.text_entry.delete("1.0", "end")
-            self.text_entry.insert("1.0", Exif(im).description)
-        except KeyError:
-            self.text_entry.delete("1.0", "end")  # Wis text_entry als er geen beschrijving is
+            description = Exif(str(path)).description
+        except (KeyError, OSError, UnicodeDecodeError):
+            description = ''  # Wis text_entry als er geen beschrijving is
+        self.loaded_description = (path, description)
+        self.text_entry.delete("1.0", "end")
+        self.text_entry.insert("1.0", description)
 
 
     def update_image_description(self):
-        import piexif
-        from PIL import Image
-
         path = self.filePanel.current_item()
         if not path or not path.is_file():
             return
 
-        # Save in Exif
+        # Save in Exif, written in the background when typing pauses
         new_description = self.text_entry.get("1.0",'end-1c')
-        im = Image.open(path)
-        Exif(im).description = new_description
+        if (path, new_description) == self.loaded_description:
+            return  # Filled in by load_image, not an edit
+        self.loaded_description = None
+        self.description_writer.schedule(path, new_description)
 
     # -- callbacks van filepanel en dirpanel --
 
@@ -139,7 +149,9 @@ class ImageViewer(ttk.Frame):
         filenamepopup.show(path, self.change_filename)
 
     def change_filename(self, path, newname):
+        self.description_writer.flush(path)
         path.replace(path.parent / newname)
+        cache.invalidate(path)
         self.filePanel.edit_current(newname)
 
     # -- show in finder --
@@ -156,8 +168,10 @@ class ImageViewer(ttk.Frame):
         path = self.filePanel.current_item()
         if not path or not path.is_file():
             return
+        self.description_writer.flush(path)
         trash = Path('~').expanduser() / '.Trash'
         path.replace(trash / path.name)
+        cache.invalidate(path)
         self.filePanel.delete_current()
 
     # -- copying and moving --
@@ -168,6 +182,7 @@ class ImageViewer(ttk.Frame):
             return
         new_dir = filedialog.askdirectory(initialdir=path, title="Copy photo")
         if new_dir:
+            self.description_writer.flush(path)
             new_path = Path(new_dir)
             path.copy(new_path / path.name)
             self.add_special_action('copy', new_path)
@@ -178,8 +193,10 @@ class ImageViewer(ttk.Frame):
             return
         new_dir = filedialog.askdirectory(initialdir=path, title="Move photo")
         if new_dir:
+            self.description_writer.flush(path)
             new_path = Path(new_dir)
             path.replace(new_path / path.name)
+            cache.invalidate(path)
             self.filePanel.delete_current()
             self.add_special_action('move', new_path)
 
@@ -189,8 +206,13 @@ class ImageViewer(ttk.Frame):
         path = self.filePanel.current_item()
         if not path or not path.is_file():
             return
-        image.rotate(path)
+        paths = [p for p in self.filePanel.selected_items() if p.is_file()]
+        for p in paths:
+            self.description_writer.flush(p)
+        image.rotate_all(paths)
         self.load_image(path)
+        for p in paths:
+            self.filePanel.refresh_thumbnail(p)
 
     # -- Lucky ---
 
@@ -198,8 +220,15 @@ class ImageViewer(ttk.Frame):
         path = self.filePanel.current_item()
         if not path or not path.is_file():
             return
+        self.description_writer.flush(path)
         image.lucky(path)
         self.load_image(path)
+        self.filePanel.refresh_thumbnail(path)
+
+    # -- Thumbnail grid --
+
+    def toggle_grid(self, event):
+        self.filePanel.toggle_view()
 
     # -- Full screen --
 
@@ -212,6 +241,19 @@ class ImageViewer(ttk.Frame):
         elif path.is_dir():
             self.dirPanel.change_path(path)
 
+    # -- Zoom and pan --
+
+    def zoom(self, event):
+        path = self.filePanel.current_item()
+        if path and path.is_file() and path.suffix.lower() in image.FILETYPES:
+            self.description_writer.flush(path)
+            zoomwindow.show(path)
+
+    # -- Timing overlay --
+
+    def toggle_timing(self, event):
+        self.imagePanel.toggle_overlay()
+
     # -- showing the help text ---
 
     def help_text(self):
@@ -224,7 +266,10 @@ class ImageViewer(ttk.Frame):
             '^F - Show image in finder\n' + \
             '^C - Copy image\n' + \
             '^M - Move image\n' + \
-            '^R - Rotate image\n' + \
+            '^R - Rotate selected images\n' + \
+            '^G - Toggle thumbnail grid\n' + \
+            '^Z - Zoom and pan (z in full screen)\n' + \
+            '^T - Show timing overlay\n' + \
             '\n'.join(extra_locations) + '\n\n'
 
     def add_special_action(self, action, path):
@@ -242,8 +287,10 @@ class ImageViewer(ttk.Frame):
         # Controleer of het event een Control-modifier bevat en een cijfer is
         if event.state & 0x4 and key.isdigit() and int(key) > 0 and int(key) <= len(self.special_actions) and path and path.is_file():
             action = self.special_actions[int(key) - 1]
+            self.description_writer.flush(path)
             if action.action == 'move':
                 path.replace(action.path / path.name)
+                cache.invalidate(path)
                 self.filePanel.delete_current()
             elif action.action == 'copy':
                 path.copy(action.path / path.name)
@@ -261,4 +308,6 @@ if __name__ == '__main__':
     viewer = ImageViewer()
     filenamepopup = FilenamePopup()
     fullscreen = FullScreen(root)
+    zoomwindow = ZoomWindow(root)
     root.mainloop()
+    viewer.description_writer.flush()  # Don't lose the last edit
@@ -0,0 +1,219 @@
+''' Reads the few metadata fields the viewer needs straight from the file header.
+
+Only the segments before the image data are read: the APP1 and SOF segments of a JPEG, the
+IHDR and eXIf chunks of a PNG, and the first IFD of a TIFF, plus the EXIF IFD it points to.
+No pixels are decoded and no dictionary of every tag is built. Other formats fall back to
+PIL, which also only reads the header. Results are cached per (path, mtime, size).
+'''
+import os
+import struct
+import threading
+from collections import OrderedDict, namedtuple
+
+from PIL import Image
+
+CACHE_ENTRIES = 10_000  # files whose metadata is remembered
+MAX_VALUE = 64 * 1024  # bytes, longer tag values are ignored
+
+# dates are the raw 'YYYY:MM:DD HH:MM:SS' strings of DateTimeOriginal, CreateDate
+# (DateTimeDigitized) and DateTime, None where missing. width and height are of the stored
+# (not rotated) image, None when unknown.
+Metadata = namedtuple('Metadata', 'orientation description dates width height')
+EMPTY = Metadata(1, None, (None, None, None), None, None)
+
+ORIENTATION = 0x0112
+DESCRIPTION = 0x010E
+DATE_TIME = 0x0132
+IMAGE_WIDTH = 0x0100
+IMAGE_LENGTH = 0x0101
+EXIF_IFD = 0x8769
+DATE_TIME_ORIGINAL = 0x9003
+DATE_TIME_DIGITIZED = 0x9004
+TYPE_SIZES = {1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 6: 1, 7: 1, 8: 2, 9: 4, 10: 8, 11: 4, 12: 8}
+SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+
+def read_ifd(read, offset, endian, wanted):
+    ''' {tag: value} for the wanted tags in the IFD at offset. read(offset, n) returns bytes
+        of the TIFF structure. Numbers are returned as int, ASCII as bytes. '''
+    values = {}
+    count = struct.unpack(endian + 'H', read(offset, 2))[0]
+    entries = read(offset + 2, 12 * count)
+    for i in range(len(entries) // 12):
+        tag, typ, n = struct.unpack_from(endian + 'HHI', entries, 12 * i)
+        if tag not in wanted or typ not in TYPE_SIZES:
+            continue
+        size = TYPE_SIZES[typ] * n
+        if size > MAX_VALUE:
+            continue
+        if size <= 4:
+            raw = entries[12 * i + 8:12 * i + 8 + size]
+        else:
+            raw = read(struct.unpack_from(endian + 'I', entries, 12 * i + 8)[0], size)
+        if typ == 2:
+            values[tag] = raw.split(b'\0', 1)[0]
+        elif typ == 3 and n >= 1:
+            values[tag] = struct.unpack_from(endian + 'H', raw)[0]
+        elif typ == 4 and n >= 1:
+            values[tag] = struct.unpack_from(endian + 'I', raw)[0]
+        elif typ == 7:
+            values[tag] = raw
+    return values
+
+
+def parse_tiff(read):
+    ''' Metadata from a TIFF structure, as found in EXIF data and TIFF files '''
+    order = read(0, 2)
+    endian = '<' if order == b'II' else '>' if order == b'MM' else None
+    if endian is None:
+        return EMPTY
+    ifd0 = read_ifd(read, struct.unpack(endian + 'I', read(4, 4))[0], endian,
+                    {ORIENTATION, DESCRIPTION, DATE_TIME, DATE_TIME_ORIGINAL, DATE_TIME_DIGITIZED,
+                     IMAGE_WIDTH, IMAGE_LENGTH, EXIF_IFD})
+    exif = {}
+    if ifd0.get(EXIF_IFD):
+        exif = read_ifd(read, ifd0[EXIF_IFD], endian, {DATE_TIME_ORIGINAL, DATE_TIME_DIGITIZED})
+    dates = tuple(value.decode('ascii', 'replace') if value else None
+                  for value in (exif.get(DATE_TIME_ORIGINAL) or ifd0.get(DATE_TIME_ORIGINAL),
+                                exif.get(DATE_TIME_DIGITIZED) or ifd0.get(DATE_TIME_DIGITIZED), ifd0.get(DATE_TIME)))
+    return Metadata(ifd0.get(ORIENTATION, 1), ifd0.get(DESCRIPTION), dates,
+                    ifd0.get(IMAGE_WIDTH), ifd0.get(IMAGE_LENGTH))
+
+
+def parse_exif(data):
+    ''' Metadata from EXIF bytes as in PIL's im.info['exif'], with or without the Exif header '''
+    if data.startswith(b'Exif\0\0'):
+        data = data[6:]
+    try:
+        return parse_tiff(lambda offset, n: data[offset:offset + n])
+    except struct.error:
+        return EMPTY
+
+
+def read_jpeg(f):
+    metadata, size = EMPTY, None
+    f.read(2)
+    while True:
+        marker = f.read(2)
+        if len(marker) < 2 or marker[0] != 0xFF or marker[1] == 0xDA:  # Start of scan, image data follows
+            break
+        length = struct.unpack('>H', f.read(2))[0]
+        if marker[1] == 0xE1 and metadata is EMPTY:
+            body = f.read(length - 2)
+            if body.startswith(b'Exif\0\0'):
+                metadata = parse_exif(body)
+        elif marker[1] in SOF_MARKERS:
+            height, width = struct.unpack('>xHH', f.read(5))
+            size = (width, height)
+            f.seek(length - 7, os.SEEK_CUR)
+        else:
+            f.seek(length - 2, os.SEEK_CUR)
+        if size and metadata is not EMPTY:
+            break
+    if size:
+        metadata = metadata._replace(width=size[0], height=size[1])
+    return metadata
+
+
+def read_png(f):
+    metadata, size = EMPTY, None
+    f.seek(8)
+    while True:
+        header = f.read(8)
+        if len(header) < 8:
+            break
+        length, kind = struct.unpack('>I4s', header)
+        if kind == b'IHDR':
+            size = struct.unpack('>II', f.read(8))
+            f.seek(length - 8 + 4, os.SEEK_CUR)
+        elif kind == b'eXIf':
+            metadata = parse_exif(f.read(length))
+            f.seek(4, os.SEEK_CUR)
+        elif kind in (b'IDAT', b'IEND'):
+            break
+        else:
+            f.seek(length + 4, os.SEEK_CUR)
+    if size:
+        metadata = metadata._replace(width=size[0], height=size[1])
+    return metadata
+
+
+def read_tiff_file(f):
+    def read(offset, n):
+        f.seek(offset)
+        return f.read(n)
+    return parse_tiff(read)
+
+
+def read_with_pil(path):
+    with Image.open(path) as im:  # Lazy, only the header is parsed
+        exif = im.getexif()
+        exif_ifd = exif.get_ifd(EXIF_IFD)
+        dates = tuple(str(value) if value else None for value in
+                      (exif_ifd.get(DATE_TIME_ORIGINAL), exif_ifd.get(DATE_TIME_DIGITIZED), exif.get(DATE_TIME)))
+        description = exif.get(DESCRIPTION)
+        if isinstance(description, str):
+            description = description.encode('latin-1', 'replace')  # How PIL decoded the ASCII tag
+        return Metadata(exif.get(ORIENTATION, 1), description, dates, im.width, im.height)
+
+
+def read_file(path):
+    try:
+        with open(path, 'rb') as f:
+            head = f.read(8)
+            f.seek(0)
+            if head.startswith(b'\xff\xd8'):
+                return read_jpeg(f)
+            if head.startswith(b'\x89PNG'):
+                return read_png(f)
+            if head[:4] in (b'II*\0', b'MM\0*'):
+                return read_tiff_file(f)
+    except struct.error:
+        return EMPTY  # Truncated or corrupt header
+    try:
+        return read_with_pil(path)
+    except (OSError, SyntaxError, ValueError):
+        return EMPTY
+
+
+class MetadataCache:
+    ''' LRU of Metadata keyed by (path, mtime, size) '''
+
+    def __init__(self, max_entries=CACHE_ENTRIES):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def read(self, path):
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        key = path, st.st_mtime_ns, st.st_size
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return self.entries[key]
+        metadata = read_file(path)
+        with self.lock:
+            self.entries[key] = metadata
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return metadata
+
+    def invalidate(self, path):
+        ''' For writes that may keep the mtime and size, like patching the orientation in place '''
+        path = os.path.abspath(path)
+        with self.lock:
+            for key in [key for key in self.entries if key[0] == path]:
+                del self.entries[key]
+
+
+cache = MetadataCache()
+
+
+def read(path):
+    ''' Metadata of the file at path, raises OSError when it cannot be read '''
+    return cache.read(str(path))
+
+
+def invalidate(path):
+    cache.invalidate(str(path))
@@ -0,0 +1,262 @@
+''' In-process stand-in for the parts of the Immich API that immich.Immich uses, for tests and
+benchmarks that must not touch a real server.
+
+    server = MockImmich(latency=0.02, error_rate=0.01).start()
+    im = Immich(server.url)
+    ...
+    print(server.stats)
+    server.stop()
+
+Latency is added to every request, error_rate is the fraction of requests answered with
+error_status before they are handled, and bandwidth limits the bytes per second read from
+request bodies (per connection). All state is kept in memory.
+'''
+import json
+import random
+import threading
+import time
+import uuid
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from immich import ID_PATTERN
+
+READ_CHUNK = 64 * 1024  # bytes read from a request body per step
+PAGE_SIZE = 250  # search results per page, like the real server
+
+
+class MockImmich:
+    def __init__(self, latency=0.0, error_rate=0.0, error_status=503, bandwidth=None, max_upload_size=None,
+                 seed=0, port=0):
+        self.latency = latency  # s
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.bandwidth = bandwidth  # bytes/s, None for unlimited
+        self.max_upload_size = max_upload_size  # larger uploads get a 413
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.albums = {}  # id -> {'albumName', 'description', 'assets': [asset id]}
+        self.assets = {}  # id -> {'id', 'checksum', 'deviceAssetId', 'albums': [album id]}
+        self.by_checksum = {}  # checksum -> asset id
+        self.reset_stats()
+        server = self
+
+        class Handler(RequestHandler):
+            mock = server
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self.httpd.daemon_threads = True
+        self.url = f'http://127.0.0.1:{self.httpd.server_address[1]}'
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def reset_stats(self):
+        with self.lock:
+            self.stats = {'requests': 0, 'errors': 0, 'bytes_in': 0, 'bytes_out': 0}
+            self.endpoints = Counter()  # 'METHOD /api/endpoint' -> requests
+
+    def count(self, **amounts):
+        with self.lock:
+            for key, amount in amounts.items():
+                self.stats[key] += amount
+
+    def inject_error(self):
+        with self.lock:
+            return self.random.random() < self.error_rate
+
+    # -- API, called with the lock held. Each returns (status, json data) --
+
+    def get_albums(self):
+        return 200, [{'id': album_id, 'albumName': album['albumName'], 'assetCount': len(album['assets'])}
+                     for album_id, album in self.albums.items()]
+
+    def create_album(self, body):
+        album_id = str(uuid.uuid4())
+        self.albums[album_id] = {'albumName': body['albumName'], 'description': body.get('description', ''),
+                                 'assets': []}
+        self.add_to_album(album_id, {'ids': body.get('assetIds', [])})
+        return 201, {'id': album_id, 'albumName': body['albumName']}
+
+    def album_info(self, album_id):
+        if album_id not in self.albums:
+            return 404, {'message': 'Album not found'}
+        album = self.albums[album_id]
+        return 200, {'id': album_id, 'albumName': album['albumName'],
+                     'assets': [self.assets[asset_id] for asset_id in album['assets']]}
+
+    def delete_album(self, album_id):
+        album = self.albums.pop(album_id, None)
+        if album is None:
+            return 404, {'message': 'Album not found'}
+        for asset_id in album['assets']:
+            self.assets[asset_id]['albums'].remove(album_id)
+        return 204, None
+
+    def add_to_album(self, album_id, body):
+        if album_id not in self.albums:
+            return 404, {'message': 'Album not found'}
+        album = self.albums[album_id]
+        results = []
+        for asset_id in body['ids']:
+            if asset_id not in self.assets:
+                results.append({'id': asset_id, 'success': False, 'error': 'not_found'})
+            elif asset_id in album['assets']:
+                results.append({'id': asset_id, 'success': False, 'error': 'duplicate'})
+            else:
+                album['assets'].append(asset_id)
+                self.assets[asset_id]['albums'].append(album_id)
+                results.append({'id': asset_id, 'success': True})
+        return 200, results
+
+    def upload(self, checksum, device_asset_id):
+        if checksum in self.by_checksum:
+            return 200, {'id': self.by_checksum[checksum], 'status': 'duplicate'}
+        asset_id = str(uuid.uuid4())
+        self.assets[asset_id] = {'id': asset_id, 'checksum': checksum, 'deviceAssetId': device_asset_id,
+                                 'albums': []}
+        self.by_checksum[checksum] = asset_id
+        return 201, {'id': asset_id, 'status': 'created'}
+
+    def bulk_upload_check(self, body):
+        results = []
+        for asset in body['assets']:
+            asset_id = self.by_checksum.get(asset['checksum'])
+            if asset_id:
+                results.append({'id': asset['id'], 'action': 'reject', 'reason': 'duplicate', 'assetId': asset_id})
+            else:
+                results.append({'id': asset['id'], 'action': 'accept'})
+        return 200, {'results': results}
+
+    def delete_assets(self, body):
+        for asset_id in body['ids']:
+            asset = self.assets.pop(asset_id, None)
+            if asset:
+                del self.by_checksum[asset['checksum']]
+                for album_id in asset['albums']:
+                    self.albums[album_id]['assets'].remove(asset_id)
+        return 204, None
+
+    def search(self, body):
+        assets = list(self.assets.values())
+        if body.get('isNotInAlbum'):
+            assets = [asset for asset in assets if not asset['albums']]
+        size = body.get('size', PAGE_SIZE)
+        page = body.get('page', 1)
+        items = assets[(page - 1) * size:page * size]
+        next_page = str(page + 1) if page * size < len(assets) else None
+        return 200, {'assets': {'items': items, 'total': len(items), 'count': len(items), 'nextPage': next_page}}
+
+    def route(self, method, path, body, headers):
+        parts = path.split('?')[0].strip('/').split('/')[1:]  # Without the leading 'api'
+        if parts == ['albums']:
+            return self.get_albums() if method == 'GET' else self.create_album(body)
+        if len(parts) == 2 and parts[0] == 'albums':
+            return self.album_info(parts[1]) if method == 'GET' else self.delete_album(parts[1])
+        if len(parts) == 3 and parts[0] == 'albums' and parts[2] == 'assets' and method == 'PUT':
+            return self.add_to_album(parts[1], body)
+        if parts == ['assets'] and method == 'POST':
+            return self.upload(headers.get('x-immich-checksum'), body.get('deviceAssetId'))
+        if parts == ['assets'] and method == 'DELETE':
+            return self.delete_assets(body)
+        if parts == ['assets', 'bulk-upload-check']:
+            return self.bulk_upload_check(body)
+        if len(parts) == 2 and parts[0] == 'assets' and method == 'GET':
+            return (200, self.assets[parts[1]]) if parts[1] in self.assets else (404, {'message': 'Not found'})
+        if parts == ['search', 'metadata']:
+            return self.search(body)
+        return 404, {'message': f'No mock for {method} {path}'}
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # Keep-alive, like the real server
+    mock = None  # Set by MockImmich on a subclass
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_body(self):
+        # Reads the body at no more than mock.bandwidth bytes/s. Uploads are not kept, only counted.
+        length = int(self.headers.get('Content-Length', 0))
+        multipart = self.headers.get('Content-Type', '').startswith('multipart/')
+        data, remaining = [], length
+        start = time.monotonic()
+        while remaining:
+            chunk = self.rfile.read(min(READ_CHUNK, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            if not multipart or len(data) == 0:
+                data.append(chunk)  # The form fields come first, that is all a mock upload needs
+            if self.mock.bandwidth:
+                ahead = (length - remaining) / self.mock.bandwidth - (time.monotonic() - start)
+                if ahead > 0:
+                    time.sleep(ahead)
+        self.mock.count(bytes_in=length)
+        return b''.join(data), length
+
+    def handle_request(self, method):
+        mock = self.mock
+        body, length = self.read_body()
+        endpoint = ID_PATTERN.sub('/{id}', self.path.split('?')[0])
+        with mock.lock:
+            mock.stats['requests'] += 1
+            mock.endpoints[f'{method} {endpoint}'] += 1
+        if mock.latency:
+            time.sleep(mock.latency)
+
+        if mock.inject_error():
+            mock.count(errors=1)
+            status, data = mock.error_status, {'message': 'Injected error'}
+        elif method == 'POST' and endpoint == '/api/assets' and mock.max_upload_size \
+                and length > mock.max_upload_size:
+            status, data = 413, {'message': 'Payload too large'}
+        else:
+            if self.headers.get('Content-Type', '').startswith('multipart/'):
+                body = parse_fields(body, self.headers['Content-Type'])
+            else:
+                try:
+                    body = json.loads(body) if body else {}
+                except ValueError:
+                    body = {}
+            with mock.lock:
+                status, data = mock.route(method, self.path, body, self.headers)
+
+        payload = json.dumps(data).encode('utf-8') if data is not None else b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+        mock.count(bytes_out=len(payload))
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def do_PUT(self):
+        self.handle_request('PUT')
+
+    def do_DELETE(self):
+        self.handle_request('DELETE')
+
+
+def parse_fields(data, content_type):
+    ''' The simple form fields of a multipart body, the file part is skipped '''
+    boundary = content_type.split('boundary=', 1)[1].encode('utf-8')
+    fields = {}
+    for part in data.split(b'--' + boundary)[1:]:
+        head, _, value = part.partition(b'\r\n\r\n')
+        if b'filename=' in head or b'name="' not in head:
+            continue
+        name = head.split(b'name="', 1)[1].split(b'"', 1)[0].decode('utf-8')
+        fields[name] = value[:-2].decode('utf-8', 'replace')  # Without the \r\n before the next boundary
+    return fields
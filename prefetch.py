@@ -0,0 +1,123 @@
+import os
+import threading
+from collections import OrderedDict
+
+from image import load_fitted
+
+PREFETCH_DEPTH = 3  # number of images decoded ahead in the browsing direction
+PREFETCH_MEMORY = 256 * 1024 * 1024  # max bytes of decoded frames kept around
+
+
+def image_bytes(im):
+    return im.width * im.height * len(im.getbands())
+
+
+def file_stamp(path):
+    ''' (mtime, size) of path like the image cache keys, None when it cannot be read '''
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+
+class Prefetcher:
+    ''' Decodes the images around the current one in a background thread, so next/previous
+        can show an already prepared frame instead of decoding after the keypress. '''
+
+    def __init__(self, size, depth=PREFETCH_DEPTH, max_bytes=PREFETCH_MEMORY):
+        self.size = size
+        self.depth = depth
+        self.max_bytes = max_bytes
+        self.list = []
+        self.current = 0
+        self.direction = 1
+        self.frames = OrderedDict()  # path -> ((mtime, size) when decoded, decoded and fitted PIL image)
+        self.failed = set()
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def set_list(self, paths, current=0):
+        with self.condition:
+            self.list = list(paths)
+            self.current = current
+            self.direction = 1
+            self.failed.clear()
+            self._evict()
+            self.condition.notify_all()
+
+    def move_to(self, index):
+        ''' Register the new current index, the direction is taken from the previous one '''
+        with self.condition:
+            if index != self.current:
+                self.direction = 1 if index > self.current else -1
+            self.current = index
+            self._evict()
+            self.condition.notify_all()
+
+    def get(self, path):
+        ''' Returns the prepared frame for path, or None if it is not ready or the file changed
+            since it was decoded. Never waits for a decode in progress. '''
+        stamp = file_stamp(path)
+        with self.condition:
+            frame = self.frames.get(path)
+            if frame is None:
+                return None
+            if frame[0] != stamp:  # Rotated or described after the prefetch, decode it again
+                del self.frames[path]
+                self.condition.notify_all()
+                return None
+            self.frames.move_to_end(path)
+            return frame[1]
+
+    def _wanted(self):
+        ''' Paths to keep decoded, most important first '''
+        indexes = [self.current]
+        indexes += [self.current + self.direction * i for i in range(1, self.depth + 1)]
+        indexes += [self.current - self.direction]  # one behind, for a quick step back
+        return [self.list[i] for i in indexes if 0 <= i < len(self.list)]
+
+    def _evict(self):
+        wanted = self._wanted()
+        for path in list(self.frames):
+            if path not in wanted:
+                del self.frames[path]
+        # Over budget: drop the least important frames first
+        for path in reversed(wanted):
+            if sum(image_bytes(im) for _, im in self.frames.values()) <= self.max_bytes:
+                break
+            self.frames.pop(path, None)
+
+    def _next_job(self):
+        # The current image is left to the viewer, it shows a draft first
+        used = sum(image_bytes(im) for _, im in self.frames.values())
+        largest_frame = self.size[0] * self.size[1] * 4
+        current = self.list[self.current] if 0 <= self.current < len(self.list) else None
+        for path in self._wanted():
+            if path in self.frames or path in self.failed or path == current:
+                continue
+            if used + largest_frame > self.max_bytes:
+                return None
+            return path
+        return None
+
+    def _run(self):
+        while True:
+            with self.condition:
+                path = self._next_job()
+                while path is None:
+                    self.condition.wait()
+                    path = self._next_job()
+            stamp = file_stamp(path)  # Before the decode, so a change during it is noticed
+            try:
+                im = load_fitted(path, self.size)
+            except OSError:
+                im = None
+            with self.condition:
+                if im is None:
+                    self.failed.add(path)
+                elif path in self._wanted():
+                    self.frames[path] = (stamp, im)
+                    self._evict()
+                self.condition.notify_all()
@@ -2,7 +2,10 @@
 - Converting them to jpeg if needed
 - Renaming them to yyyy-mm-dd hh:mm:ss format
 '''
+import json
+import os
 import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from datetime import datetime, timedelta
 from pathlib import Path
 from time import strptime
@@ -10,51 +13,52 @@ from time import strptime
 from PIL import ExifTags, Image
 from wand.image import Image as HeicImage
 
+import metadata
 from image import orientate, FILETYPES
 
-import subprocess
+FILE_FORMAT = '%Y-%m-%d %H.%M.%S'
+EXIF_DATE_FORMAT = '%Y:%m:%d %H:%M:%S'
+# Tried in this order: DateTimeOriginal, CreateDate (DateTimeDigitized), DateTime
+EXIF_DATE_TAGS = [ExifTags.Base.DateTimeOriginal, ExifTags.Base.DateTimeDigitized, ExifTags.Base.DateTime]
+
 
 class DateNotFoundException(Exception):
     pass
 
-def get_photo_date_taken(file):
-    """Gets the date taken for a photo through a shell."""
-
-    #if file.suffix.lower() != '.heic':
-    #    return datetime.fromtimestamp(file.stat().st_birthtime)
-
-    # Onderstaande is nodig omdat bij foto's die je opslaat de mac de filetijd aanpast en we willen de foto creatietijd
-    cmd = "mdls '%s'" % file
-    output = subprocess.check_output(cmd, shell = True)
-    lines = output.decode("ascii").split("\n")
-    for l in lines:
-        if "kMDItemContentCreationDate" in l:
-            datetime_str = l.split("= ")[1]
-            return datetime.strptime(datetime_str, "%Y-%m-%d %H:%M:%S +0000")
+
+def get_exif_date(file):
+    ''' Capture date from the EXIF data in the file header, without decoding the pixels '''
+    values = metadata.read(file).dates  # In the order of EXIF_DATE_TAGS
+    if not any(values) and file.suffix.lower() == '.heic':
+        with HeicImage.ping(filename=str(file)) as im:  # ping reads the metadata only
+            values = [im.metadata.get('exif:' + ExifTags.TAGS[tag]) for tag in EXIF_DATE_TAGS]
+    for value in values:
+        try:
+            return datetime.strptime(str(value).strip('\0 '), EXIF_DATE_FORMAT)
+        except ValueError:
+            continue
     raise DateNotFoundException("No EXIF date taken found for file %s" % file)
 
-def set_right_name( file ):
-    #return file # Nu even niks omdat os niet Contents Created time kan uitlezen.
-    file_format = '%Y-%m-%d %H.%M.%S'
+
+def get_photo_date_taken(file):
+    """Gets the date taken for a photo from its EXIF data, falling back to the file times."""
     try:
-        date_in_name = strptime(file.stem, file_format)
-    except:
-        # Not in the right format rename to created date/time
-        created = get_photo_date_taken( file )
-        new_name = created.strftime(file_format) + file.suffix
-        new_path = file.parent / new_name
-        while new_path.is_file():
-            created += timedelta(0, 1)  # 0 days, 1 second
-            new_name = created.strftime(file_format) + file.suffix
-            new_path = file.parent / new_name
-        file = file.rename(new_path)
-    return file
-
-def save_backup(file: Path):
-    backup_dir = file.parent / 'backup'
-    backup_dir.mkdir(exist_ok=True)  # create if necessary
-    backup_file =  backup_dir / file.name
-    file.rename( backup_file )
+        return get_exif_date(file)
+    except (DateNotFoundException, OSError):
+        pass
+    # Bij foto's die je opslaat past de mac de filetijd aan, daarom alleen als het niet anders kan
+    st = file.stat()
+    return datetime.fromtimestamp(getattr(st, 'st_birthtime', st.st_mtime))
+
+
+def date_for_rename(file):
+    ''' The date to name file after, or None if it is named right already '''
+    try:
+        strptime(file.stem, FILE_FORMAT)
+        return None
+    except ValueError:
+        return get_photo_date_taken(file)
+
 
 def convert_from_heic(file):
     im = HeicImage(filename=file)
@@ -71,28 +75,188 @@ def convert_from_other(file):
     im.close()
 
 
-def prepare_folder(folder):
+def convert_to_jpeg(file):
+    if file.suffix.lower() == '.heic':
+        convert_from_heic( file )
+    else:
+        convert_from_other( file )
+
+
+# -- Plan, journal and apply --
+
+JOURNAL_NAME = '.prepare-journal'
+
+
+def unique_name(created, suffixes, taken):
+    ''' First name based on created that is free for all suffixes, a second later each try '''
+    while True:
+        stem = created.strftime(FILE_FORMAT)
+        if not any(stem + suffix in taken for suffix in suffixes):
+            return stem
+        created += timedelta(0, 1)  # 0 days, 1 second
+
+
+def plan_folder(path, pool):
+    ''' Builds the list of steps to prepare the folder from a single directory scan.
+        Steps are dicts with op 'rename', 'convert' or 'backup' and src/dst names relative to path.
+        Name collisions are resolved against an in-memory set of the names that are taken. '''
+    names = sorted(entry.name for entry in os.scandir(path))
+    taken = set(names)
+    files = [path / name for name in names if Path(name).suffix.lower() in FILETYPES + ['.heic']]
+
+    steps = []
+    for file, created in zip(files, pool.map(date_for_rename, files, chunksize=8)):
+        name = file.name
+        convert = file.suffix.lower() not in ('.jpeg', '.jpg')
+        if created is None and convert and file.stem + '.jpg' in taken:
+            created = datetime.strptime(file.stem, FILE_FORMAT)  # Named right but the jpg is taken
+        if created is not None:
+            taken.discard(name)
+            stem = unique_name(created, [file.suffix] + (['.jpg'] if convert else []), taken)
+            new_name = stem + file.suffix
+            taken.add(new_name)
+            steps.append({'op': 'rename', 'src': name, 'dst': new_name})
+            name = new_name
+        if convert:
+            jpg_name = Path(name).stem + '.jpg'
+            taken.add(jpg_name)
+            steps.append({'op': 'convert', 'src': name, 'dst': jpg_name})
+            steps.append({'op': 'backup', 'src': name, 'dst': 'backup/' + name})
+    return steps
+
+
+class Journal:
+    ''' Append-only record of the plan and of the steps that are done. The first line is the
+        plan, each further line the index of a finished step. Lines are flushed to disk right away
+        so an interrupted run can be resumed or rolled back. '''
+
+    def __init__(self, path):
+        self.path = path / JOURNAL_NAME
+
+    def exists(self):
+        return self.path.is_file()
+
+    def load(self):
+        with open(self.path) as f:
+            lines = f.read().splitlines()
+        steps = json.loads(lines[0])
+        done = {int(line) for line in lines[1:] if line.strip().isdigit()}  # Last line may be cut off
+        return steps, done
+
+    def start(self, steps):
+        with open(self.path, 'w') as f:
+            f.write(json.dumps(steps) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    def mark_done(self, index):
+        with open(self.path, 'a') as f:
+            f.write(f'{index}\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    def remove(self):
+        self.path.unlink()
+
+
+def is_done(path, step):
+    ''' Checks on disk whether a step that is not in the journal was done just before a crash '''
+    src, dst = path / step['src'], path / step['dst']
+    if step['op'] in ('rename', 'backup'):
+        return not src.exists() and dst.exists()
+    return False  # A convert may have been cut off halfway, so do it again
+
+
+def apply_step(path, step):
+    src, dst = path / step['src'], path / step['dst']
+    print(f"{step['op']} {step['src']} -> {step['dst']}")
+    if step['op'] == 'rename':
+        src.rename(dst)
+    elif step['op'] == 'backup':
+        dst.parent.mkdir(exist_ok=True)  # create if necessary
+        src.rename(dst)
+    elif step['op'] == 'convert':
+        convert_to_jpeg(src)
+
+
+def undo_step(path, step):
+    src, dst = path / step['src'], path / step['dst']
+    print(f"undo {step['op']} {step['src']} -> {step['dst']}")
+    if step['op'] in ('rename', 'backup'):
+        if dst.exists() and not src.exists():
+            dst.rename(src)
+    elif step['op'] == 'convert':
+        dst.unlink(missing_ok=True)
+
+
+def prepare_folder(folder, workers=None):
     path = Path( folder )
-    for file in path.iterdir():
-        lower_suffix = file.suffix.lower()
+    journal = Journal(path)
 
-        if not lower_suffix in FILETYPES + ['.heic']:
-            continue
-        print( file )
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        if journal.exists():
+            print('Resuming an interrupted run')
+            steps, done = journal.load()
+        else:
+            steps, done = plan_folder(path, pool), set()
+            journal.start(steps)
+
+        def finish(index):
+            done.add(index)
+            journal.mark_done(index)
 
-        # Rename if needed
-        oldname = file.name
-        file = set_right_name( file )
+        pending = [i for i in range(len(steps)) if i not in done]
+        for i in pending:
+            if is_done(path, steps[i]):
+                finish(i)
 
-        # convert to jpeg if needed
-        if not lower_suffix in ('.jpeg','.jpg'):
-            if lower_suffix == '.heic':
-                convert_from_heic( file )
-            else:
-                convert_from_other( file )
-            save_backup( file )
+        # Renames first, they are quick and the conversions depend on them
+        for i in pending:
+            if i not in done and steps[i]['op'] == 'rename':
+                apply_step(path, steps[i])
+                finish(i)
+
+        # convert to jpeg if needed, in parallel. The backup of a file follows its conversion.
+        jobs = {pool.submit(apply_step, path, steps[i]): i
+                for i in pending if i not in done and steps[i]['op'] == 'convert'}
+        for job in as_completed(jobs):
+            i = jobs[job]
+            try:
+                job.result()
+            except Exception as e:
+                print(f"Cannot convert {steps[i]['src']}: {e}")
+                continue
+            finish(i)
+        for i in pending:
+            if i not in done and steps[i]['op'] == 'backup' and i - 1 in done:
+                apply_step(path, steps[i])
+                finish(i)
+
+    if len(done) == len(steps):
+        journal.remove()
+    else:
+        print(f'{len(steps) - len(done)} steps failed, run again to retry or use --rollback')
+
+
+def rollback_folder(folder):
+    ''' Undoes the finished steps of an interrupted run, in reverse order '''
+    path = Path( folder )
+    journal = Journal(path)
+    if not journal.exists():
+        print('Nothing to roll back')
+        return
+    steps, done = journal.load()
+    for i in reversed(range(len(steps))):
+        if i in done:
+            undo_step(path, steps[i])
+        elif steps[i]['op'] == 'convert':
+            (path / steps[i]['dst']).unlink(missing_ok=True)  # Left over from a cut off conversion
+    journal.remove()
 
 
 if __name__=='__main__':
     folder = sys.argv[1]
-    prepare_folder(folder)
\ No newline at end of file
+    if '--rollback' in sys.argv[2:]:
+        rollback_folder(folder)
+    else:
+        prepare_folder(folder)
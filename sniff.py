@@ -0,0 +1,136 @@
+''' Recognizes image and video files by their first bytes instead of parsing the whole file.
+
+    sniff(path)     -> ('image', 'jpeg'), ('video', 'mp4'), ... or None
+    category(path)  -> 'image', 'video' or None
+    verify(path)    -> True when the whole image parses, for integrity audits
+
+Results are cached per (path, mtime, size), so files that did not change are not read again.
+'''
+import os
+import threading
+from collections import OrderedDict
+
+from PIL import Image
+
+SNIFF_BYTES = 4096  # bytes read from the start of a file
+CACHE_ENTRIES = 100_000  # files whose result is remembered
+
+# ISO base media (ftyp) major brands. Other brands (M4A audio, JPEG XL, ...) are not recognized.
+HEIC_BRANDS = {b'heic', b'heix', b'hevc', b'hevx', b'heim', b'heis', b'mif1', b'msf1'}
+AVIF_BRANDS = {b'avif', b'avis'}
+MOV_BRANDS = {b'qt  '}
+VIDEO_BRANDS = {b'isom', b'iso2', b'iso3', b'iso4', b'iso5', b'iso6', b'mp41', b'mp42', b'avc1', b'dash',
+                b'M4V ', b'M4VH', b'M4VP', b'f4v ', b'mmp4', b'MSNV', b'NDSC', b'NDSH', b'NDXC', b'NDXH',
+                b'XAVC', b'CAEP', b'3gp4', b'3gp5', b'3gp6', b'3g2a', b'3g2b', b'3g2c'}
+BMP_HEADER_SIZES = {12, 40, 52, 56, 64, 108, 124}  # Sizes of the known BMP info headers
+QUICKTIME_ATOMS = {b'moov', b'mdat', b'wide', b'free', b'skip', b'pnot'}  # Old .mov files without ftyp
+PIL_FORMATS = {'jpeg', 'png', 'gif', 'tiff', 'bmp', 'webp'}  # Formats verify can check with PIL
+
+
+def sniff_bytes(head):
+    ''' (category, format) for a file starting with head, None when not recognized '''
+    if head.startswith(b'\xff\xd8\xff'):
+        return 'image', 'jpeg'
+    if head.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'image', 'png'
+    if head[:6] in (b'GIF87a', b'GIF89a'):
+        return 'image', 'gif'
+    if head[:4] in (b'II*\0', b'MM\0*', b'IIRO', b'IIU\0'):  # TIFF and the raw formats built on it
+        return 'image', 'tiff'
+    if (head.startswith(b'BM') and head[6:10] == b'\0\0\0\0'
+            and int.from_bytes(head[14:18], 'little') in BMP_HEADER_SIZES):
+        return 'image', 'bmp'
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'image', 'webp'
+    if head[:4] == b'RIFF' and head[8:12] == b'AVI ':
+        return 'video', 'avi'
+    if head[4:8] == b'ftyp':
+        return sniff_ftyp(head)
+    if head[4:8] in QUICKTIME_ATOMS:
+        return 'video', 'mov'
+    if head.startswith(b'\x1a\x45\xdf\xa3'):
+        return 'video', 'webm' if b'webm' in head[:64] else 'mkv'
+    if head[:1] == head[188:189] == head[376:377] == b'\x47':
+        return 'video', 'mpegts'
+    if head[4:5] == head[196:197] == head[388:389] == b'\x47':  # AVCHD .mts: 4 byte timestamp per packet
+        return 'video', 'm2ts'
+    if head.startswith(b'\0\0\1\xba'):
+        return 'video', 'mpeg'
+    if head.startswith(b'\x30\x26\xb2\x75\x8e\x66\xcf\x11'):
+        return 'video', 'wmv'
+    if head.startswith(b'FLV\x01') and not head[4] & 0xFA and head[5:9] == b'\0\0\0\x09':  # Version 1, audio/video flags
+        return 'video', 'flv'
+    return None
+
+
+def sniff_ftyp(head):
+    size = int.from_bytes(head[:4], 'big')
+    brands = {head[8:12]} | {head[i:i + 4] for i in range(16, min(size, len(head)) - 3, 4)}
+    if head[8:12] in AVIF_BRANDS or (head[8:12] == b'mif1' and brands & AVIF_BRANDS):
+        return 'image', 'avif'
+    if head[8:12] in HEIC_BRANDS:
+        return 'image', 'heic'
+    if head[8:12] in MOV_BRANDS:
+        return 'video', 'mov'
+    if head[8:12] in VIDEO_BRANDS:
+        return 'video', 'mp4'
+    return None
+
+
+class SniffCache:
+    ''' LRU of sniff results keyed by (path, mtime, size) '''
+
+    def __init__(self, max_entries=CACHE_ENTRIES):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def sniff(self, path):
+        path = os.path.abspath(path)
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        key = path, st.st_mtime_ns, st.st_size
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return self.entries[key]
+        try:
+            with open(path, 'rb') as f:
+                result = sniff_bytes(f.read(SNIFF_BYTES))
+        except OSError:
+            return None
+        with self.lock:
+            self.entries[key] = result
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return result
+
+
+cache = SniffCache()
+
+
+def sniff(path):
+    return cache.sniff(path)
+
+
+def category(path):
+    result = cache.sniff(path)
+    return result[0] if result else None
+
+
+def verify(path):
+    ''' Deep check: parses the whole image with PIL. Slow, meant for integrity audits.
+        Formats PIL cannot read (HEIC, AVIF) are judged on their header only. '''
+    result = cache.sniff(path)
+    if not result or result[0] != 'image':
+        return False
+    if result[1] not in PIL_FORMATS:
+        return True
+    try:
+        with Image.open(path) as im:
+            im.verify()
+        return True
+    except (OSError, SyntaxError):
+        return False
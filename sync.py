@@ -1,11 +1,15 @@
 from dotenv import load_dotenv
 
-from immich import Immich, is_image_or_video, calulate_checksum
+from checksumindex import get_index
+from immich import Immich, is_image_or_video, calculate_checksums, hash_file
+from syncpipeline import sync_folders
 
 import os
+import sys
 
 
 def sync_folder(im: Immich, directory: str):
+    # One folder, one step at a time. sync_folders does the same for many folders concurrently.
     print('Syncing ' + directory)
     album_name = directory.rsplit('/', 1)[1]
     album_id = im.create_album(album_name)
@@ -15,12 +19,10 @@ def sync_folder(im: Immich, directory: str):
     album_contents = {asset['checksum']: asset['id'] for asset in album_info['assets']}
 
     # Get the hashes of all files in the directory
-    dir_contents = {}
-    for file in sorted(os.listdir(directory)):
-        file_path = os.path.join(directory, file)
-        if not os.path.isfile(file_path) or not is_image_or_video(file_path):
-            continue
-        dir_contents[calulate_checksum(file_path)] = file_path
+    file_paths = (os.path.join(directory, file) for file in sorted(os.listdir(directory)))
+    file_paths = (file_path for file_path in file_paths
+                  if os.path.isfile(file_path) and is_image_or_video(file_path))
+    dir_contents = {checksum: file_path for file_path, checksum in calculate_checksums(file_paths)}
 
     # Delete all images from the album that are not in the directory (anymore)
     to_delete = [asset_id for checksum, asset_id in album_contents.items() if checksum not in dir_contents]
@@ -28,15 +30,21 @@ def sync_folder(im: Immich, directory: str):
         print(f'Deleting {len(to_delete)} assets')
         im.delete_assets(to_delete)
 
-    # Add all images from the directory that are not in the album
-    to_add = [file_path for checksum, file_path in dir_contents.items() if checksum not in album_contents]
-    for file_path in to_add:
-        print('Uploading ' + file_path)
-        asset_id = im.upload_asset(file_path)
+    # Add all images from the directory that are not in the album.
+    # Files already on the server (in another album) are found with one request per BULK_SIZE files.
+    to_add = {checksum: file_path for checksum, file_path in dir_contents.items() if checksum not in album_contents}
+    existing = im.existing_assets(to_add)
+    asset_ids = []
+    for checksum, file_path in to_add.items():
+        asset_id = existing.get(checksum)
+        if not asset_id:
+            print('Uploading ' + file_path)
+            asset_id = im.upload_asset(file_path, checked=True)
         if asset_id:
-            res = im.add_asset_to_album(album_id, asset_id)
-            if res[0].get('error'):
-                print(f'Cannot add image {asset_id} to Album to {album_id}', res[0]['error'], res[0]['id'])
+            asset_ids.append(asset_id)
+    for res in im.add_assets_to_album(album_id, asset_ids):
+        if res.get('error'):
+            print(f'Cannot add image {res["id"]} to Album to {album_id}', res['error'], res['id'])
 
 
 def delete_assets_without_album(im: Immich):
@@ -53,10 +61,22 @@ def is_int(s: str):
         return False
 
 
+def verify_index():
+    mismatches = get_index().verify(hash_file)
+    for path in mismatches:
+        print('Checksum changed: ' + path)
+    print(f'{len(mismatches)} files changed without a new modification time')
+
+
 if __name__ == "__main__":
+    if '--verify-index' in sys.argv:
+        verify_index()
+        sys.exit()
     load_dotenv()
     im = Immich()
     delete_assets_without_album(im)
-    for directory in sorted(os.listdir('/Users/hp/foto')):
-        if is_int(directory[:4]):
-            sync_folder(im, f'/Users/hp/foto/{directory}')
+    directories = [f'/Users/hp/foto/{directory}' for directory in sorted(os.listdir('/Users/hp/foto'))
+                   if is_int(directory[:4])]
+    print(sync_folders(im, directories, deep_verify='--deep-verify' in sys.argv))
+    print(im.latency_report())
+    print(f'Pruned {get_index().prune()} checksums of deleted files')
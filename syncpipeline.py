@@ -0,0 +1,267 @@
+''' Concurrent version of sync.sync_folder for many folders at once.
+
+Every file flows through the stages scan -> hash -> check -> upload -> attach. The stages are
+connected by bounded queues and each has its own number of worker threads, so the disk is
+hashing while the network is uploading. The results are the same as sync_folder's: album
+assets that are no longer in the folder are deleted, folder files that are not in the album
+are uploaded (unless already on the server) and added to it.
+'''
+import os
+import queue
+import threading
+import traceback
+
+from immich import Immich, is_image_or_video, calulate_checksum, BULK_SIZE
+
+FOLDER_WORKERS = 2  # folders scanned at the same time
+HASH_WORKERS = 4
+UPLOAD_WORKERS = 4
+MAX_UPLOAD_BYTES = 512 * 1024 * 1024  # bytes of files being uploaded at the same time
+QUEUE_SIZE = 1000  # max items waiting between two stages
+CHECK_IDLE = 0.5  # s without new files after which a partial check batch is sent
+
+STOP = object()  # Sentinel that tells a worker to quit
+
+
+class ByteBudget:
+    ''' Limits the number of bytes in flight. A single item larger than the limit is let through
+        on its own so it cannot block forever. '''
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.used = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, size: int):
+        with self.condition:
+            while self.used and self.used + size > self.limit:
+                self.condition.wait()
+            self.used += size
+
+    def release(self, size: int):
+        with self.condition:
+            self.used -= size
+            self.condition.notify_all()
+
+
+class Folder:
+    ''' Progress of one directory through the pipeline '''
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.album_id = None
+        self.album_contents = {}  # checksum -> asset id, what is in the album now
+        self.dir_contents = {}  # checksum -> file path, what is in the directory
+        self.files = None  # number of files to hash, known when the scan is done
+        self.hashed = 0
+        self.checked = False
+        self.uploads = 0  # uploads still running
+        self.asset_ids = []  # to add to the album
+        self.lock = threading.Lock()
+
+
+class SyncPipeline:
+    def __init__(self, im: Immich, folder_workers=FOLDER_WORKERS, hash_workers=HASH_WORKERS,
+                 upload_workers=UPLOAD_WORKERS, max_upload_bytes=MAX_UPLOAD_BYTES, deep_verify=False, verbose=True):
+        self.im = im
+        self.folder_workers = folder_workers
+        self.hash_workers = hash_workers
+        self.upload_workers = upload_workers
+        self.upload_budget = ByteBudget(max_upload_bytes)
+        self.deep_verify = deep_verify  # Parse every image instead of only looking at its first bytes
+        self.verbose = verbose
+
+        self.folder_queue = queue.Queue()
+        self.hash_queue = queue.Queue(QUEUE_SIZE)
+        self.check_queue = queue.Queue(QUEUE_SIZE)
+        self.upload_queue = queue.Queue(QUEUE_SIZE)
+        self.attach_queue = queue.Queue()
+        self.finished = queue.Queue()
+        self.stats = {'hashed': 0, 'uploaded': 0, 'uploaded_bytes': 0, 'existing': 0, 'deleted': 0,
+                      'attached': 0, 'errors': 0}
+        self.stats_lock = threading.Lock()
+
+    def log(self, message: str):
+        if self.verbose:
+            print(message)
+
+    def count(self, key: str, n: int = 1):
+        with self.stats_lock:
+            self.stats[key] += n
+
+    def run(self, directories: list):
+        ''' Syncs all directories and returns the stats '''
+        stages = [(self._scan_worker, self.folder_queue, self.folder_workers),
+                  (self._hash_worker, self.hash_queue, self.hash_workers),
+                  (self._check_worker, self.check_queue, 1),  # Batches per folder, so one thread
+                  (self._upload_worker, self.upload_queue, self.upload_workers),
+                  (self._attach_worker, self.attach_queue, 1)]
+        threads = []
+        for target, _, workers in stages:
+            for _ in range(workers):
+                thread = threading.Thread(target=target, daemon=True)
+                thread.start()
+                threads.append(thread)
+
+        for directory in directories:
+            self.folder_queue.put(Folder(directory))
+        for _ in directories:
+            self.finished.get()
+
+        for _, stage_queue, workers in stages:
+            for _ in range(workers):
+                stage_queue.put(STOP)
+        for thread in threads:
+            thread.join()
+        return self.stats
+
+    def _error(self, message: str):
+        self.count('errors')
+        print(message)
+        traceback.print_exc()
+
+    # -- Stages --
+
+    def _scan_worker(self):
+        while (folder := self.folder_queue.get()) is not STOP:
+            self.log('Syncing ' + folder.directory)
+            try:
+                album_name = folder.directory.rstrip('/').rsplit('/', 1)[1]
+                folder.album_id = self.im.create_album(album_name)
+                album_info = self.im.album_info(folder.album_id)
+                folder.album_contents = {asset['checksum']: asset['id'] for asset in album_info['assets']}
+                with os.scandir(folder.directory) as entries:
+                    file_paths = sorted(entry.path for entry in entries if entry.is_file())
+            except (Exception, SystemExit):
+                self._error(f'Cannot sync {folder.directory}')
+                self.finished.put(folder)
+                continue
+            for file_path in file_paths:
+                self.hash_queue.put((folder, file_path))
+            with folder.lock:
+                folder.files = len(file_paths)
+                done = folder.hashed == folder.files
+            if done:
+                self.check_queue.put((folder, None))
+
+    def _hash_worker(self):
+        while (item := self.hash_queue.get()) is not STOP:
+            folder, file_path = item
+            checksum = None
+            try:
+                if is_image_or_video(file_path, deep=self.deep_verify):
+                    checksum = calulate_checksum(file_path)
+                    self.count('hashed')
+            except (Exception, SystemExit):
+                self._error(f'Cannot hash {file_path}')
+            with folder.lock:
+                new = checksum and checksum not in folder.dir_contents
+                if checksum:
+                    folder.dir_contents[checksum] = file_path
+            if new and checksum not in folder.album_contents:
+                self.check_queue.put((folder, (checksum, file_path)))
+            # Counted only after the file is queued, so the done marker cannot overtake it.
+            # Not under the lock: a full check_queue would block _check, which takes it as well.
+            with folder.lock:
+                folder.hashed += 1
+                done = folder.hashed == folder.files
+            if done:
+                self.check_queue.put((folder, None))  # All files of the folder are hashed
+
+    def _check_worker(self):
+        batches = {}  # folder -> [(checksum, file_path)]
+        while True:
+            try:
+                item = self.check_queue.get(timeout=CHECK_IDLE)
+            except queue.Empty:
+                for folder in list(batches):
+                    self._check(folder, batches.pop(folder))  # Don't let uploads wait for a full batch
+                continue
+            if item is STOP:
+                break
+            folder, file = item
+            batch = batches.setdefault(folder, [])
+            if file:
+                batch.append(file)
+            if len(batch) >= BULK_SIZE or not file:
+                self._check(folder, batches.pop(folder))
+            if not file:
+                self._finish_checks(folder)
+
+    def _check(self, folder: Folder, batch: list):
+        ''' Sends files that are not on the server yet to the uploaders '''
+        if not batch:
+            return
+        try:
+            existing = self.im.existing_assets([checksum for checksum, _ in batch])
+        except (Exception, SystemExit):
+            self._error(f'Cannot check files of {folder.directory}')
+            return
+        for checksum, file_path in batch:
+            if checksum in existing:
+                self.count('existing')
+                with folder.lock:
+                    folder.asset_ids.append(existing[checksum])
+            else:
+                with folder.lock:
+                    folder.uploads += 1
+                self.upload_queue.put((folder, file_path))
+
+    def _finish_checks(self, folder: Folder):
+        # The directory is fully hashed: delete what is no longer there
+        to_delete = [asset_id for checksum, asset_id in folder.album_contents.items()
+                     if checksum not in folder.dir_contents]
+        if to_delete:
+            self.log(f'Deleting {len(to_delete)} assets from {folder.directory}')
+            try:
+                self.im.delete_assets(to_delete)
+                self.count('deleted', len(to_delete))
+            except (Exception, SystemExit):
+                self._error(f'Cannot delete assets of {folder.directory}')
+        with folder.lock:
+            folder.checked = True
+            done = folder.uploads == 0
+        if done:
+            self.attach_queue.put(folder)
+
+    def _upload_worker(self):
+        while (item := self.upload_queue.get()) is not STOP:
+            folder, file_path = item
+            asset_id = None
+            acquired = 0
+            try:
+                size = os.path.getsize(file_path)  # Raises when the file was removed after the scan
+                self.upload_budget.acquire(size)
+                acquired = size
+                self.log('Uploading ' + file_path)
+                asset_id = self.im.upload_asset(file_path, checked=True)
+                self.count('uploaded')
+                self.count('uploaded_bytes', size)
+            except (Exception, SystemExit):
+                self._error(f'Cannot upload {file_path}')
+            finally:
+                if acquired:
+                    self.upload_budget.release(acquired)
+            with folder.lock:
+                if asset_id:
+                    folder.asset_ids.append(asset_id)
+                folder.uploads -= 1
+                done = folder.checked and folder.uploads == 0
+            if done:
+                self.attach_queue.put(folder)
+
+    def _attach_worker(self):
+        while (folder := self.attach_queue.get()) is not STOP:
+            try:
+                for res in self.im.add_assets_to_album(folder.album_id, folder.asset_ids):
+                    if res.get('error'):
+                        print(f'Cannot add image {res["id"]} to Album to {folder.album_id}', res['error'], res['id'])
+                    else:
+                        self.count('attached')
+            except (Exception, SystemExit):
+                self._error(f'Cannot add assets to the album of {folder.directory}')
+            self.finished.put(folder)
+
+
+def sync_folders(im: Immich, directories: list, **kwargs):
+    return SyncPipeline(im, **kwargs).run(directories)
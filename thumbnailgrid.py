@@ -0,0 +1,209 @@
+import io
+import queue
+import tkinter
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image, ImageTk
+
+from image import FILETYPES
+from thumbstore import get_store, THUMB_SIZE
+
+CELL_WIDTH = THUMB_SIZE + 16
+CELL_HEIGHT = THUMB_SIZE + 32
+COLUMNS = 3
+THUMB_WORKERS = 4
+POLL_INTERVAL = 50  # ms between checks for finished thumbnails
+
+
+class ThumbnailGrid(tkinter.Canvas):
+    ''' Grid view on the items of a FilePanel's Listbox. The Listbox stays the model: selecting
+        in the grid selects in the Listbox, so all FilePanel callbacks keep working.
+        Only the visible rows are drawn and only their thumbnails are requested. '''
+
+    def __init__(self, parent, filelist, get_dir, open_item_callback, current_index):
+        tkinter.Canvas.__init__(self, parent, width=COLUMNS * CELL_WIDTH, height=400,
+                                highlightthickness=0, takefocus=1)
+        self.filelist = filelist
+        self.get_dir = get_dir
+        self.open_item_callback = open_item_callback
+        self.current_index = current_index  # Index of the item shown, as FilePanel picks it
+
+        self.photos = {}  # name -> PhotoImage, kept to prevent garbage collection
+        self.requested = set()
+        self.visible = set()
+        self.results = queue.Queue()
+        self.executor = ThreadPoolExecutor(max_workers=THUMB_WORKERS)
+        self.pending = 0
+
+        self.bind('<Configure>', lambda event: self.redraw())
+        self.bind('<Button-1>', self._click)
+        self.bind('<Double-Button-1>', self._double_click)
+        self.bind('<MouseWheel>', self._wheel)
+        self.bind('<Button-4>', lambda event: self.yview_scroll(-3, 'units'))
+        self.bind('<Button-5>', lambda event: self.yview_scroll(3, 'units'))
+        self.bind('<Left>', lambda event: self._move(-1))
+        self.bind('<Right>', lambda event: self._move(1))
+        self.bind('<Up>', lambda event: self._move(-self.columns()))
+        self.bind('<Down>', lambda event: self._move(self.columns()))
+
+    def columns(self):
+        return max(1, self.winfo_width() // CELL_WIDTH)
+
+    def reset(self):
+        ''' Directory changed: forget all thumbnails '''
+        self.photos.clear()
+        self.requested.clear()
+        self.yview_moveto(0)
+        self.redraw()
+
+    def forget(self, name):
+        ''' The file changed: drop its thumbnail so it is requested again '''
+        self.photos.pop(name, None)
+        self.requested.discard(name)
+
+    # Every way of scrolling redraws, so the newly visible rows get painted
+    def yview(self, *args):
+        result = tkinter.Canvas.yview(self, *args)
+        if args:
+            self.redraw()
+        return result
+
+    def yview_moveto(self, fraction):
+        tkinter.Canvas.yview_moveto(self, fraction)
+        self.redraw()
+
+    def yview_scroll(self, number, what):
+        tkinter.Canvas.yview_scroll(self, number, what)
+        self.redraw()
+
+    def redraw(self):
+        items = self.filelist.get(0, tkinter.END)
+        columns = self.columns()
+        rows = (len(items) + columns - 1) // columns
+        self.configure(scrollregion=(0, 0, columns * CELL_WIDTH, rows * CELL_HEIGHT),
+                       yscrollincrement=CELL_HEIGHT // 4)
+        self.delete('cell')
+
+        top = int(self.canvasy(0))
+        first_row = top // CELL_HEIGHT
+        last_row = (top + self.winfo_height()) // CELL_HEIGHT
+        selection = set(self.filelist.curselection())
+        self.visible = set()
+        for index in range(first_row * columns, min(len(items), (last_row + 1) * columns)):
+            name = items[index]
+            self.visible.add(name)
+            x = (index % columns) * CELL_WIDTH
+            y = (index // columns) * CELL_HEIGHT
+            if index in selection:
+                self.create_rectangle(x + 2, y + 2, x + CELL_WIDTH - 2, y + CELL_HEIGHT - 2,
+                                      fill='#3874d8', outline='', tags='cell')
+            center = (x + CELL_WIDTH // 2, y + 8 + THUMB_SIZE // 2)
+            if name in self.photos:
+                self.create_image(*center, image=self.photos[name], tags='cell')
+            else:
+                self.create_rectangle(center[0] - 20, center[1] - 20, center[0] + 20, center[1] + 20,
+                                      outline='grey', tags='cell')
+                self._request(name)
+            self.create_text(x + CELL_WIDTH // 2, y + THUMB_SIZE + 20, text=name, width=CELL_WIDTH - 8,
+                             tags='cell')
+
+        # Keep memory in check on huge folders
+        if len(self.photos) > 4 * len(self.visible) + 100:
+            for name in list(self.photos):
+                if name not in self.visible:
+                    self.forget(name)
+
+    def see(self, index):
+        columns = self.columns()
+        rows = max(1, (self.filelist.size() + columns - 1) // columns)
+        top = int(self.canvasy(0))
+        y = (index // columns) * CELL_HEIGHT
+        if y < top or y + CELL_HEIGHT > top + self.winfo_height():
+            self.yview_moveto(y / (rows * CELL_HEIGHT))
+        else:
+            self.redraw()
+
+    # -- Thumbnail generation --
+
+    def _request(self, name):
+        if name in self.requested or name == '..':
+            return
+        path = self.get_dir() / name
+        if path.suffix not in FILETYPES:
+            return  # Directory
+        self.requested.add(name)
+        self.executor.submit(self._load, name, path)
+        self.pending += 1
+        if self.pending == 1:
+            self.after(POLL_INTERVAL, self._poll)
+
+    def _load(self, name, path):
+        ''' Runs in a worker thread, no Tk calls here '''
+        im = None
+        try:
+            if name not in self.visible or path.parent != self.get_dir():
+                return  # Scrolled away in the meantime
+            im = Image.open(io.BytesIO(get_store().thumbnail(path)))
+            im.load()
+        except OSError:
+            im = None
+        except Exception as e:  # Anything else must not leave the thumbnail pending forever
+            print(f'Cannot make a thumbnail of {path}: {e}')
+            im = None
+        finally:
+            self.results.put((path, name, im))
+
+    def _poll(self):
+        changed = False
+        while True:
+            try:
+                path, name, im = self.results.get_nowait()
+            except queue.Empty:
+                break
+            self.pending -= 1
+            if path.parent != self.get_dir():
+                continue
+            if im is None:
+                self.requested.discard(name)  # Retry when it becomes visible again
+                continue
+            self.photos[name] = ImageTk.PhotoImage(im)
+            changed = True
+        if changed:
+            self.redraw()
+        if self.pending:
+            self.after(POLL_INTERVAL, self._poll)
+
+    # -- Events --
+
+    def _index_at(self, event):
+        column = event.x // CELL_WIDTH
+        if column >= self.columns():
+            return None
+        index = int(self.canvasy(event.y)) // CELL_HEIGHT * self.columns() + column
+        return index if index < self.filelist.size() else None
+
+    def select(self, index):
+        index = max(0, min(index, self.filelist.size() - 1))
+        self.filelist.selection_clear(0, tkinter.END)
+        self.filelist.select_set(index)
+        self.filelist.activate(index)
+        self.filelist.event_generate('<<ListboxSelect>>')
+        self.see(index)
+
+    def _click(self, event):
+        self.focus_set()
+        index = self._index_at(event)
+        if index is not None:
+            self.select(index)
+
+    def _double_click(self, event):
+        if self._index_at(event) is not None:
+            self.open_item_callback(event)
+
+    def _move(self, delta):
+        index = self.current_index()
+        self.select(index + delta if index is not None else 0)
+        return 'break'
+
+    def _wheel(self, event):
+        self.yview_scroll(-3 if event.delta > 0 else 3, 'units')
@@ -0,0 +1,69 @@
+import io
+import os
+import sqlite3
+import threading
+from pathlib import Path
+
+from image import decode_draft
+
+THUMB_SIZE = 160  # max width and height of a thumbnail in pixels
+STORE_PATH = Path('~/.cache/imageviewer/thumbnails.sqlite').expanduser()
+
+
+class ThumbStore:
+    ''' Persistent store of JPEG thumbnails in an SQLite blob table.
+        A thumbnail is only returned when the file's mtime and size still match. '''
+
+    def __init__(self, path=STORE_PATH):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('''CREATE TABLE IF NOT EXISTS thumbs (
+                               path TEXT PRIMARY KEY, mtime INTEGER, size INTEGER, data BLOB)''')
+        self.db.commit()
+
+    def get(self, path):
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        with self.lock:
+            row = self.db.execute('SELECT data FROM thumbs WHERE path=? AND mtime=? AND size=?',
+                                  (path, st.st_mtime_ns, st.st_size)).fetchone()
+        return row[0] if row else None
+
+    def put(self, path, data):
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO thumbs VALUES (?, ?, ?, ?)',
+                            (path, st.st_mtime_ns, st.st_size, data))
+            self.db.commit()
+
+    def invalidate(self, path):
+        with self.lock:
+            self.db.execute('DELETE FROM thumbs WHERE path=?', (os.path.abspath(path),))
+            self.db.commit()
+
+    def thumbnail(self, path):
+        ''' Returns the JPEG thumbnail bytes for path, generating and storing them if needed '''
+        data = self.get(path)
+        if data is None:
+            im = decode_draft(path, (THUMB_SIZE, THUMB_SIZE))
+            buffer = io.BytesIO()
+            im.convert('RGB').save(buffer, 'JPEG', quality=80)
+            data = buffer.getvalue()
+            self.put(path, data)
+        return data
+
+
+store = None
+store_lock = threading.Lock()  # Thumbnail workers may ask for the store at the same time
+
+
+def get_store():
+    ''' The store is opened lazily so the database is only created when thumbnails are used '''
+    global store
+    if store is None:
+        with store_lock:
+            if store is None:
+                store = ThumbStore()
+    return store
@@ -0,0 +1,374 @@
+''' Zoom and pan for very large images, backed by a multi-resolution tile pyramid.
+
+Level 0 is the full resolution image, every next level is half the size, up to the level that
+fits in a single tile. Levels are built lazily, the first time a tile of them is needed: the
+image is decoded at that level's size (JPEGs with draft, so at 1/2 to 1/8 scale where possible),
+cut into tiles and stored on disk. From then on only the tiles that are on screen are read and
+kept in memory, so panning around a 100 MP scan does not hold its full bitmap.
+'''
+import hashlib
+import math
+import os
+import queue
+import shutil
+import threading
+import tkinter
+from collections import OrderedDict
+from pathlib import Path
+
+from PIL import Image, ImageTk
+
+from image import get_orientation, apply_orientation
+from modal import Modal
+
+TILE_SIZE = 256  # pixels
+TILE_QUALITY = 90  # JPEG quality of the tiles on disk
+TILE_CACHE_PATH = Path('~/.cache/imageviewer/tiles').expanduser()
+TILE_DISK_CACHE = 2 * 1024 * 1024 * 1024  # bytes of tiles kept on disk, oldest images are removed first
+TILE_MARGIN = 1  # rings of tiles around the viewport that are loaded ahead
+POLL_INTERVAL = 30  # ms between checks for loaded tiles
+ZOOM_STEP = 1.25
+MAX_ZOOM = 8  # display pixels per image pixel
+PAN_STEP = 100  # display pixels per arrow key press
+
+
+def cache_directory(path):
+    ''' Tile directory of this version of the file '''
+    st = os.stat(path)
+    key = f'{os.path.abspath(path)}\0{st.st_mtime_ns}\0{st.st_size}'
+    return TILE_CACHE_PATH / hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def prune_disk_cache(keep, max_bytes=TILE_DISK_CACHE):
+    ''' Removes the least recently used pyramids until the cache is below max_bytes '''
+    pyramids = []
+    for directory in TILE_CACHE_PATH.iterdir():
+        size = sum(f.stat().st_size for f in directory.rglob('*') if f.is_file())
+        pyramids.append((directory.stat().st_mtime, size, directory))
+    total = sum(size for _, size, _ in pyramids)
+    for _, size, directory in sorted(pyramids):
+        if total <= max_bytes:
+            break
+        if directory != keep:
+            shutil.rmtree(directory, ignore_errors=True)
+            total -= size
+
+
+class TilePyramid:
+    ''' The tiles of one image. Tiles are loaded by a background thread: the view says which
+        tiles it wants with want(), finished tiles are announced on self.loaded. '''
+
+    def __init__(self, path):
+        self.path = str(path)
+        with Image.open(self.path) as im:
+            self.orientation = get_orientation(im)
+            width, height = im.size
+        if self.orientation in (5, 6, 7, 8):
+            width, height = height, width
+        self.size = (width, height)  # Of the upright image
+        self.top_level = max(0, math.ceil(math.log2(max(width, height) / TILE_SIZE)))
+        self.directory = cache_directory(self.path)
+
+        self.tiles = OrderedDict()  # (level, col, row) -> Image, least recently used first
+        self.max_tiles = 64
+        self.failed = set()
+        self.wanted = []  # keys in the order they should be loaded
+        self.loading = None  # key the thread is working on
+        self.loaded = queue.Queue()
+        self.condition = threading.Condition()
+        self.closed = False
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def level_size(self, level):
+        return tuple(math.ceil(side / 2 ** level) for side in self.size)
+
+    def tile_counts(self, level):
+        return tuple(math.ceil(side / TILE_SIZE) for side in self.level_size(level))
+
+    def tile_box(self, key):
+        ''' (left, top, right, bottom) of the tile in level pixels '''
+        level, col, row = key
+        width, height = self.level_size(level)
+        return (col * TILE_SIZE, row * TILE_SIZE,
+                min((col + 1) * TILE_SIZE, width), min((row + 1) * TILE_SIZE, height))
+
+    def tile(self, key):
+        with self.condition:
+            if key in self.tiles:
+                self.tiles.move_to_end(key)
+                return self.tiles[key]
+        return None
+
+    def fallback(self, key):
+        ''' The tile cut from a coarser level that is in memory, for until the real one is loaded '''
+        level, col, row = key
+        left, top, right, bottom = self.tile_box(key)
+        for k in range(1, self.top_level - level + 1):
+            parent = self.tile((level + k, col >> k, row >> k))
+            if parent is None:
+                continue
+            offset_x, offset_y = (col >> k) * TILE_SIZE, (row >> k) * TILE_SIZE
+            box = (left / 2 ** k - offset_x, top / 2 ** k - offset_y,
+                   right / 2 ** k - offset_x, bottom / 2 ** k - offset_y)
+            return parent.resize((right - left, bottom - top), Image.BILINEAR, box=box)
+        return None
+
+    def want(self, keys, max_tiles):
+        ''' Replaces the wanted tiles. At most max_tiles tiles are kept in memory. '''
+        with self.condition:
+            self.max_tiles = max_tiles
+            self.wanted = [key for key in keys
+                           if key not in self.tiles and key not in self.failed and key != self.loading]
+            self.condition.notify_all()
+
+    def busy(self):
+        with self.condition:
+            return bool(self.wanted) or self.loading is not None
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.tiles.clear()
+            self.condition.notify_all()
+
+    # -- Background thread, no Tk calls here --
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.wanted and not self.closed:
+                    self.condition.wait()
+                if self.closed:
+                    return
+                key = self.loading = self.wanted.pop(0)
+            try:
+                if not (self.directory / str(key[0]) / 'complete').exists():
+                    self._build_level(key[0])
+                tile = Image.open(self.directory / str(key[0]) / f'{key[1]}_{key[2]}.jpg')
+                tile.load()
+            except (OSError, ValueError, Image.DecompressionBombError) as e:
+                print(f'Cannot load tile {key} of {self.path}: {e}')
+                tile = None
+            with self.condition:
+                if tile is None:
+                    self.failed.add(key)
+                else:
+                    self.tiles[key] = tile
+                    while len(self.tiles) > self.max_tiles:
+                        self.tiles.popitem(last=False)
+                self.loading = None
+            self.loaded.put(key)
+
+    def _build_level(self, level):
+        # PIL cannot decode part of a JPEG, so the whole level is decoded once and saved as tiles
+        width, height = self.level_size(level)
+        size = (height, width) if self.orientation in (5, 6, 7, 8) else (width, height)
+        with Image.open(self.path) as im:
+            im.draft('RGB', size)  # JPEG: decode at 1/2, 1/4 or 1/8 scale when that still covers size
+            if im.mode != 'RGB':
+                im = im.convert('RGB')
+            if im.size != size:
+                im = im.resize(size, Image.LANCZOS, reducing_gap=3.0)
+            im = apply_orientation(im, self.orientation)
+        directory = self.directory / str(level)
+        directory.mkdir(parents=True, exist_ok=True)
+        cols, rows = self.tile_counts(level)
+        for row in range(rows):
+            for col in range(cols):
+                box = self.tile_box((level, col, row))
+                im.crop(box).save(directory / f'{col}_{row}.jpg', quality=TILE_QUALITY)
+        (directory / 'complete').touch()
+        os.utime(self.directory)  # Most recently used for prune_disk_cache
+        prune_disk_cache(keep=self.directory)
+
+
+class ZoomView(tkinter.Canvas):
+    ''' Canvas that shows a TilePyramid at any zoom. Drag or use the arrow keys to pan, the
+        mouse wheel or +/- to zoom, 0 to fit the image and 1 for 100%. '''
+
+    def __init__(self, parent, **kwargs):
+        tkinter.Canvas.__init__(self, parent, highlightthickness=0, takefocus=1, **kwargs)
+        self.pyramid = None
+        self.scale = 1.0  # display pixels per image pixel
+        self.x0 = self.y0 = 0.0  # image pixel at the top left of the canvas
+        self.photos = {}  # (key, width, height, is_fallback) -> PhotoImage of the tiles on screen
+        self.poll_job = None
+        self.drag_start = None
+
+        self.bind('<Configure>', lambda event: self.redraw())
+        self.bind('<ButtonPress-1>', self._press)
+        self.bind('<B1-Motion>', self._drag)
+        self.bind('<MouseWheel>', lambda event: self.zoom(ZOOM_STEP if event.delta > 0 else 1 / ZOOM_STEP, event))
+        self.bind('<Button-4>', lambda event: self.zoom(ZOOM_STEP, event))
+        self.bind('<Button-5>', lambda event: self.zoom(1 / ZOOM_STEP, event))
+        self.bind('<plus>', lambda event: self.zoom(ZOOM_STEP))
+        self.bind('<equal>', lambda event: self.zoom(ZOOM_STEP))
+        self.bind('<minus>', lambda event: self.zoom(1 / ZOOM_STEP))
+        self.bind('<Key-0>', lambda event: self.fit())
+        self.bind('<Key-1>', lambda event: self.zoom(1 / self.scale))
+        self.bind('<Left>', lambda event: self.pan(-PAN_STEP, 0))
+        self.bind('<Right>', lambda event: self.pan(PAN_STEP, 0))
+        self.bind('<Up>', lambda event: self.pan(0, -PAN_STEP))
+        self.bind('<Down>', lambda event: self.pan(0, PAN_STEP))
+
+    def open(self, path):
+        self.close()
+        self.pyramid = TilePyramid(path)
+        self.fit()
+
+    def close(self):
+        if self.poll_job:
+            self.after_cancel(self.poll_job)
+            self.poll_job = None
+        if self.pyramid:
+            self.pyramid.close()
+            self.pyramid = None
+        self.photos.clear()
+        self.delete('tile')
+
+    def fit_scale(self):
+        width, height = self.pyramid.size
+        return min(self.winfo_width() / width, self.winfo_height() / height, 1)
+
+    def fit(self):
+        if self.pyramid:
+            self.scale = self.fit_scale()
+            self.redraw()
+
+    def zoom(self, factor, event=None):
+        if not self.pyramid:
+            return
+        # Keep the image pixel under the mouse (or the center) in place
+        x = event.x if event else self.winfo_width() / 2
+        y = event.y if event else self.winfo_height() / 2
+        image_x, image_y = self.x0 + x / self.scale, self.y0 + y / self.scale
+        self.scale = max(min(self.scale * factor, MAX_ZOOM), self.fit_scale())
+        self.x0, self.y0 = image_x - x / self.scale, image_y - y / self.scale
+        self.redraw()
+
+    def pan(self, dx, dy):
+        self.x0 += dx / self.scale
+        self.y0 += dy / self.scale
+        self.redraw()
+
+    def _press(self, event):
+        self.focus_set()
+        self.drag_start = (event.x, event.y)
+
+    def _drag(self, event):
+        if self.drag_start:
+            self.pan(self.drag_start[0] - event.x, self.drag_start[1] - event.y)
+            self.drag_start = (event.x, event.y)
+
+    def _clamp(self):
+        # Keep the image on screen, centered in a direction where it is smaller than the canvas
+        for axis, canvas_size in ((0, self.winfo_width()), (1, self.winfo_height())):
+            image_size = self.pyramid.size[axis]
+            view_size = canvas_size / self.scale
+            origin = self.x0 if axis == 0 else self.y0
+            if view_size >= image_size:
+                origin = (image_size - view_size) / 2
+            else:
+                origin = max(0.0, min(origin, image_size - view_size))
+            if axis == 0:
+                self.x0 = origin
+            else:
+                self.y0 = origin
+
+    def redraw(self):
+        if not self.pyramid:
+            return
+        pyramid = self.pyramid
+        self._clamp()
+        level = max(0, min(pyramid.top_level, int(math.floor(math.log2(1 / self.scale)))))
+        factor = self.scale * 2 ** level  # display pixels per level pixel
+        left, top = self.x0 / 2 ** level, self.y0 / 2 ** level  # in level pixels
+        cols, rows = pyramid.tile_counts(level)
+        first_col, first_row = int(left // TILE_SIZE), int(top // TILE_SIZE)
+        last_col = min(cols - 1, int((left + self.winfo_width() / factor) // TILE_SIZE))
+        last_row = min(rows - 1, int((top + self.winfo_height() / factor) // TILE_SIZE))
+
+        self.delete('tile')
+        photos = {}
+        wanted = [(pyramid.top_level, col, row) for row in range(pyramid.tile_counts(pyramid.top_level)[1])
+                  for col in range(pyramid.tile_counts(pyramid.top_level)[0])]  # Fallback for everything
+        for row in range(max(0, first_row), last_row + 1):
+            for col in range(max(0, first_col), last_col + 1):
+                key = (level, col, row)
+                box = pyramid.tile_box(key)
+                x, y = round((box[0] - left) * factor), round((box[1] - top) * factor)
+                width = round((box[2] - left) * factor) - x
+                height = round((box[3] - top) * factor) - y
+                tile = pyramid.tile(key)
+                is_fallback = tile is None
+                if is_fallback:
+                    wanted.append(key)
+                photo_key = (key, width, height, is_fallback)
+                photo = self.photos.get(photo_key)
+                if photo is None:
+                    if is_fallback:
+                        tile = pyramid.fallback(key)
+                    if tile is None or width <= 0 or height <= 0:
+                        continue
+                    if tile.size != (width, height):
+                        tile = tile.resize((width, height), Image.BILINEAR if factor < 1 else Image.NEAREST)
+                    photo = ImageTk.PhotoImage(tile)
+                photos[photo_key] = photo
+                self.create_image(x, y, image=photo, anchor=tkinter.NW, tags='tile')
+        self.photos = photos  # Only the tiles on screen are kept
+
+        # Load ahead a ring of tiles around the viewport
+        for row in range(max(0, first_row - TILE_MARGIN), min(rows, last_row + 1 + TILE_MARGIN)):
+            for col in range(max(0, first_col - TILE_MARGIN), min(cols, last_col + 1 + TILE_MARGIN)):
+                if (level, col, row) not in wanted:
+                    wanted.append((level, col, row))
+        visible = (last_col - first_col + 1 + 2 * TILE_MARGIN) * (last_row - first_row + 1 + 2 * TILE_MARGIN)
+        pyramid.want(wanted, max_tiles=2 * visible + 8)
+        if pyramid.busy() and not self.poll_job:
+            self.poll_job = self.after(POLL_INTERVAL, self._poll)
+
+    def _poll(self):
+        self.poll_job = None
+        if not self.pyramid:
+            return
+        changed = False
+        while True:
+            try:
+                self.pyramid.loaded.get_nowait()
+                changed = True
+            except queue.Empty:
+                break
+        if changed:
+            self.redraw()
+        if self.pyramid.busy() and not self.poll_job:
+            self.poll_job = self.after(POLL_INTERVAL, self._poll)
+
+
+class ZoomWindow(Modal):
+    ''' Full screen ZoomView, closed with Escape '''
+
+    def __init__(self, root):
+        self.view = None
+        self.return_to = None
+        Modal.__init__(self)
+        self.top.geometry(f"{root.winfo_screenwidth()}x{root.winfo_screenheight()}+0+0")
+        self.view = ZoomView(self.top, bg='black')
+        self.view.pack(fill=tkinter.BOTH, expand=tkinter.YES)
+
+    def show(self, path, return_to=None):
+        ''' return_to is a Modal that gets the focus back when the zoom window closes '''
+        Modal.show(self)
+        self.return_to = return_to
+        self.top.update_idletasks()  # The canvas size is needed to fit the image
+        self.view.open(path)
+        self.view.focus_set()
+
+    def hide(self, event=None):
+        if self.view:
+            self.view.close()  # Frees the tiles
+        Modal.hide(self)
+        if self.return_to:
+            self.return_to.top.grab_set()
+            self.return_to.top.focus_set()
+            self.return_to = None
@@ -0,0 +1,109 @@
+''' Timing spans for the viewer's hot path.
+
+    with span('decode'):
+        im.load()
+
+When timing is off (the default) span() returns a shared no-op, so an instrumented call costs
+one function call. Turn it on with enable(), the ^T overlay, or IMAGEVIEWER_TIMING=1.
+IMAGEVIEWER_TRACE=<file> turns it on as well and writes all spans as a Chrome trace
+(chrome://tracing or ui.perfetto.dev) when the program exits.
+'''
+import atexit
+import json
+import os
+import threading
+import time
+from collections import deque
+
+WINDOW = 200  # latest durations per span name used for p50 and p95
+MAX_TRACE_EVENTS = 1_000_000  # spans kept for the trace file, later ones are dropped
+
+TRACE_PATH = os.environ.get('IMAGEVIEWER_TRACE')
+enabled = bool(os.environ.get('IMAGEVIEWER_TIMING') or TRACE_PATH)
+
+lock = threading.Lock()
+samples = {}  # name -> deque of the latest durations in ms
+last = {}  # name -> duration of the latest span in ms
+trace_events = []
+origin = time.perf_counter()
+
+
+class Span:
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        record(self.name, self.start, time.perf_counter())
+
+
+class NoSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+NO_SPAN = NoSpan()
+
+
+def span(name):
+    return Span(name) if enabled else NO_SPAN
+
+
+def now():
+    return time.perf_counter()
+
+
+def record(name, start, end):
+    ''' Records a span measured by hand with now(), for work that starts and ends in different calls '''
+    if not enabled:
+        return
+    ms = (end - start) * 1000
+    with lock:
+        samples.setdefault(name, deque(maxlen=WINDOW)).append(ms)
+        last[name] = ms
+        if TRACE_PATH and len(trace_events) < MAX_TRACE_EVENTS:
+            trace_events.append({'name': name, 'ph': 'X', 'pid': os.getpid(), 'tid': threading.get_ident(),
+                                 'ts': (start - origin) * 1e6, 'dur': (end - start) * 1e6})
+
+
+def enable(on=True):
+    global enabled
+    enabled = on
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def report():
+    ''' One line per span name: latest duration, p50 and p95 of the last WINDOW, in ms '''
+    with lock:
+        stats = {name: (last[name], percentile(times, 0.5), percentile(times, 0.95))
+                 for name, times in samples.items()}
+    lines = [f"{'span':24} {'last':>7} {'p50':>7} {'p95':>7}"]
+    for name, (latest, p50, p95) in sorted(stats.items()):
+        lines.append(f'{name:24} {latest:7.1f} {p50:7.1f} {p95:7.1f}')
+    return '\n'.join(lines)
+
+
+def write_trace(path=None):
+    path = path or TRACE_PATH
+    with lock:
+        events = list(trace_events)
+    with open(path, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+
+if TRACE_PATH:
+    atexit.register(write_trace)
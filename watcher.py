@@ -0,0 +1,269 @@
+''' Watches the current directory for added, removed, renamed and modified files.
+Uses inotify (through ctypes) on Linux and falls back to polling with scandir elsewhere.
+Changes are coalesced and handed over through a queue, so a Tk widget can apply them from its
+own thread.
+'''
+import ctypes
+import ctypes.util
+import os
+import queue
+import select
+import struct
+import sys
+import threading
+import time
+from collections import namedtuple
+
+COALESCE_DELAY = 0.3  # s of quiet before a burst of events is delivered
+MAX_DELAY = 2.0  # s after which changes are delivered even when events keep coming
+POLL_INTERVAL = 1.0  # s between directory mtime checks of the polling watcher
+FULL_SCAN_INTERVAL = 10.0  # s between scans that stat every file to find modified files
+FULL_SCAN_SHARE = 0.01  # at most this fraction of the time is spent in those scans, large directories wait longer
+
+# Sets of names, renamed maps old name -> new name
+Changes = namedtuple('Changes', 'added removed renamed modified')
+
+# inotify constants from <sys/inotify.h>
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = getattr(os, 'O_CLOEXEC', 0)
+WATCH_MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE \
+             | IN_DELETE_SELF | IN_MOVE_SELF
+EVENT_HEADER = struct.Struct('iIII')  # wd, mask, cookie, len
+
+
+def list_dir(path):
+    ''' name -> inode for all entries in path, no stat calls needed '''
+    with os.scandir(path) as entries:
+        return {entry.name: entry.inode() for entry in entries}
+
+
+def stat_dir(path):
+    ''' name -> (inode, mtime, size) for all entries in path '''
+    result = {}
+    with os.scandir(path) as entries:
+        for entry in entries:
+            try:
+                st = entry.stat(follow_symlinks=False)
+            except OSError:
+                continue
+            result[entry.name] = (st.st_ino, st.st_mtime_ns, st.st_size)
+    return result
+
+
+class DirWatcher:
+    ''' Base class: collects touched names from the backend in a thread and delivers
+        coalesced Changes to self.changes. Subclasses implement _wait_events. '''
+
+    def __init__(self, path):
+        self.path = str(path)
+        self.changes = queue.Queue()
+        self.stopped = threading.Event()
+        self.known = set()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self, entries=None):
+        ''' Starts delivering changes. entries maps name -> inode of the names the caller listed
+            after the watcher was created, the directory is listed here when None. Changes made
+            between creating and starting the watcher are reported once it runs. '''
+        if entries is None:
+            entries = list_dir(self.path)
+        self._set_entries(entries)
+        self.thread.start()
+        return self
+
+    def _set_entries(self, entries):
+        self.known = set(entries)
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread.ident is None:
+            self._close()  # Never started
+
+    def _wait_events(self, timeout):
+        ''' Returns (touched names, renames old -> new, rescan needed) '''
+        raise NotImplementedError
+
+    def _run(self):
+        touched, renames = set(), {}
+        first_event = last_event = None
+        while not self.stopped.is_set():
+            new_touched, new_renames, rescan = self._wait_events(COALESCE_DELAY / 3)
+            if rescan:
+                new_touched |= self._rescan()
+            now = time.monotonic()
+            if new_touched or new_renames:
+                touched |= new_touched
+                renames.update(new_renames)
+                first_event = first_event or now
+                last_event = now
+            if first_event and (now - last_event >= COALESCE_DELAY or now - first_event >= MAX_DELAY):
+                changes = self._classify(touched, renames)
+                if any(changes):
+                    self.changes.put(changes)
+                touched, renames = set(), {}
+                first_event = last_event = None
+        self._close()
+
+    def _rescan(self):
+        try:
+            current = set(list_dir(self.path))
+        except OSError:
+            current = set()
+        return current ^ self.known
+
+    def _classify(self, touched, renames):
+        ''' Turns the touched names into Changes by looking at what is on disk now '''
+        added, removed, modified, renamed = set(), set(), set(), {}
+        for old, new in renames.items():
+            if old in self.known and not os.path.lexists(os.path.join(self.path, old)) \
+                    and os.path.lexists(os.path.join(self.path, new)):
+                renamed[old] = new
+                if new in self.known:
+                    modified.add(new)  # Renamed over an existing file, as in an atomic save
+                self.known.discard(old)
+                self.known.add(new)
+                touched.discard(old)
+                touched.discard(new)
+        for name in touched:
+            exists = os.path.lexists(os.path.join(self.path, name))
+            if exists and name in self.known:
+                modified.add(name)
+            elif exists:
+                added.add(name)
+                self.known.add(name)
+            elif name in self.known:
+                removed.add(name)
+                self.known.discard(name)
+        return Changes(added, removed, renamed, modified)
+
+    def _close(self):
+        pass
+
+
+class PollingWatcher(DirWatcher):
+    ''' Portable watcher: checks the directory mtime every POLL_INTERVAL and stats all files
+        every full_scan_interval, or less often when that takes long (None: never, so only
+        added, removed and renamed files are noticed). Renames are recognized by inode. '''
+
+    def __init__(self, path, full_scan_interval=FULL_SCAN_INTERVAL):
+        DirWatcher.__init__(self, path)
+        self.dir_mtime = os.stat(self.path).st_mtime_ns  # Before the caller lists the directory
+        self.snapshot = {}
+        self.full_scan_interval = full_scan_interval
+        self.scan_interval = full_scan_interval
+        self.last_full_scan = time.monotonic()
+
+    def _set_entries(self, entries):
+        DirWatcher._set_entries(self, entries)
+        # No stats yet, the first full scan fills them in
+        self.snapshot = {name: (inode, None, None) for name, inode in entries.items()}
+
+    def _wait_events(self, timeout):
+        if self.stopped.wait(POLL_INTERVAL):
+            return set(), {}, False
+        try:
+            dir_mtime = os.stat(self.path).st_mtime_ns
+            full_scan = self.scan_interval is not None and time.monotonic() - self.last_full_scan >= self.scan_interval
+            if dir_mtime == self.dir_mtime and not full_scan:
+                return set(), {}, False
+            self.dir_mtime = dir_mtime
+            if full_scan:
+                started = time.monotonic()
+                snapshot = stat_dir(self.path)
+                self.last_full_scan = time.monotonic()
+                self.scan_interval = max(self.full_scan_interval, (self.last_full_scan - started) / FULL_SCAN_SHARE)
+            else:
+                # Only names changed, keep the old stats of the files that are still there
+                snapshot = {}
+                for name, inode in list_dir(self.path).items():
+                    old = self.snapshot.get(name)
+                    snapshot[name] = old if old and old[0] == inode else (inode, None, None)
+        except OSError:
+            return set(), {}, False
+
+        kept = snapshot.keys() & self.snapshot.keys()
+        replaced = {name for name in kept if snapshot[name][0] != self.snapshot[name][0]}  # Renamed over
+        touched = snapshot.keys() ^ self.snapshot.keys() | replaced
+        touched |= {name for name in kept
+                    if self.snapshot[name][1] is not None and snapshot[name] != self.snapshot[name]}
+        old_by_inode = {self.snapshot[name][0]: name for name in self.snapshot.keys() - snapshot.keys()}
+        renames = {old_by_inode[snapshot[name][0]]: name
+                   for name in snapshot.keys() - self.snapshot.keys() | replaced
+                   if snapshot[name][0] in old_by_inode}
+        self.snapshot = snapshot
+        return touched, renames, False
+
+
+class InotifyWatcher(DirWatcher):
+    ''' Linux watcher on top of inotify, called through ctypes '''
+
+    libc = None
+
+    def __init__(self, path):
+        DirWatcher.__init__(self, path)
+        if InotifyWatcher.libc is None:
+            InotifyWatcher.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        if self.libc.inotify_add_watch(self.fd, os.fsencode(self.path), WATCH_MASK) < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, f'inotify_add_watch failed for {self.path}')
+        self.moved_from = {}  # cookie -> name, to pair the two halves of a rename
+
+    def _wait_events(self, timeout):
+        touched, renames, rescan = set(), {}, False
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return touched, renames, rescan
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return touched, renames, rescan
+        offset = 0
+        while offset < len(data):
+            _, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                rescan = True
+            elif mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                self.stopped.set()  # The directory itself is gone
+            elif mask & IN_MOVED_FROM:
+                self.moved_from[cookie] = name
+                touched.add(name)
+            elif mask & IN_MOVED_TO and cookie in self.moved_from:
+                renames[self.moved_from.pop(cookie)] = name
+                touched.add(name)
+            elif name:
+                touched.add(name)
+        return touched, renames, rescan
+
+    def _rescan(self):
+        # After an overflow any known file might have been modified as well
+        return DirWatcher._rescan(self) | self.known
+
+    def _close(self):
+        os.close(self.fd)
+
+
+def watch(path, full_scan_interval=FULL_SCAN_INTERVAL):
+    ''' Returns the best available watcher for path. Create it before listing the directory
+        and start() it with the listing, so no change can slip in between. '''
+    if sys.platform.startswith('linux'):
+        try:
+            return InotifyWatcher(path)
+        except (OSError, AttributeError):
+            pass
+    return PollingWatcher(path, full_scan_interval)